@@ -0,0 +1,254 @@
+import os
+import csv
+import json
+import uuid
+import random
+from datetime import date, timedelta
+
+# Synthetic, deterministic inputs for the offline benchmark (benchmark_pipeline.py):
+# - Synthea-shaped patient CSVs (patients, allergies, conditions, immunizations, medications, observations,
+#   procedures) with the columns csv_to_db.py and combine_patient_data.py read
+# - A trial corpus in the clinicaltrials.gov API v2 study format, with inclusion/exclusion criteria text built
+#   from the same conditions and medications, so retrieval has real signal. fake_llm_server.py serves it.
+# The same seed always produces the same files.
+# Example: python benchmark_data.py --patients 10000 --trials 2000 --output-dir ./benchmark_runs/data
+
+# (SNOMED code, description, medication often prescribed for it)
+CONDITIONS = [
+    ('44054006', 'Diabetes mellitus type 2 (disorder)', 'metformin hydrochloride 500 MG Oral Tablet'),
+    ('59621000', 'Essential hypertension (disorder)', 'lisinopril 10 MG Oral Tablet'),
+    ('195967001', 'Asthma (disorder)', 'albuterol 0.09 MG/ACTUAT Metered Dose Inhaler'),
+    ('49436004', 'Atrial fibrillation (disorder)', 'apixaban 5 MG Oral Tablet'),
+    ('433144002', 'Chronic kidney disease stage 3 (disorder)', 'furosemide 40 MG Oral Tablet'),
+    ('370143000', 'Major depressive disorder (disorder)', 'sertraline 50 MG Oral Tablet'),
+    ('162864005', 'Body mass index 30+ - obesity (finding)', 'orlistat 120 MG Oral Capsule'),
+    ('254637007', 'Non-small cell lung cancer (disorder)', 'pembrolizumab 100 MG/4ML Injection'),
+    ('254837009', 'Malignant neoplasm of breast (disorder)', 'tamoxifen 20 MG Oral Tablet'),
+    ('13645005', 'Chronic obstructive lung disease (disorder)', 'tiotropium 18 MCG Inhalation Powder'),
+    ('53741008', 'Coronary arteriosclerosis (disorder)', 'atorvastatin 40 MG Oral Tablet'),
+    ('84114007', 'Heart failure (disorder)', 'carvedilol 12.5 MG Oral Tablet'),
+    ('69896004', 'Rheumatoid arthritis (disorder)', 'methotrexate 2.5 MG Oral Tablet'),
+    ('230690007', 'Cerebrovascular accident (disorder)', 'clopidogrel 75 MG Oral Tablet'),
+    ('26929004', "Alzheimer's disease (disorder)", 'donepezil 10 MG Oral Tablet'),
+    ('40055000', 'Chronic sinusitis (disorder)', 'fluticasone 50 MCG/ACTUAT Nasal Spray'),
+    ('38341003', 'Hypertensive disorder (disorder)', 'amlodipine 5 MG Oral Tablet'),
+    ('55822004', 'Hyperlipidemia (disorder)', 'simvastatin 20 MG Oral Tablet'),
+    ('235595009', 'Gastroesophageal reflux disease (disorder)', 'omeprazole 20 MG Delayed Release Oral Capsule'),
+    ('87433001', 'Pulmonary emphysema (disorder)', 'budesonide 0.25 MG/ML Inhalation Suspension'),
+]
+ALLERGIES = [
+    ('91936005', 'Allergy to penicillin', 'allergy', 'medication'),
+    ('300913006', 'Shellfish allergy', 'allergy', 'food'),
+    ('232347008', 'Dander (animal) allergy', 'allergy', 'environment'),
+    ('419474003', 'Allergy to mould', 'allergy', 'environment'),
+    ('91935009', 'Allergy to peanuts', 'allergy', 'food'),
+    ('294505008', 'Allergy to sulfonamide', 'intolerance', 'medication'),
+]
+IMMUNIZATIONS = [
+    ('140', 'Influenza  seasonal  injectable  preservative free'),
+    ('113', 'Td (adult) preservative free'),
+    ('133', 'Pneumococcal conjugate PCV 13'),
+    ('208', 'SARS-COV-2 (COVID-19) vaccine  mRNA  spike protein  LNP  preservative free  30 mcg/0.3mL dose'),
+    ('43', 'Hep B  adult'),
+]
+PROCEDURES = [
+    ('430193006', 'Medication reconciliation (procedure)'),
+    ('710824005', 'Assessment of health and social care needs (procedure)'),
+    ('73761001', 'Colonoscopy (procedure)'),
+    ('252160004', 'Standard pregnancy test (procedure)'),
+    ('68254000', 'Removal of intrauterine device (procedure)'),
+    ('76601001', 'Intramuscular injection (procedure)'),
+    ('171207006', 'Depression screening (procedure)'),
+]
+# (LOINC code, description, units, low, high)
+OBSERVATIONS = [
+    ('8302-2', 'Body Height', 'cm', 150, 195),
+    ('29463-7', 'Body Weight', 'kg', 50, 130),
+    ('39156-5', 'Body mass index (BMI) [Ratio]', 'kg/m2', 18, 42),
+    ('8462-4', 'Diastolic Blood Pressure', 'mm[Hg]', 60, 100),
+    ('8480-6', 'Systolic Blood Pressure', 'mm[Hg]', 100, 170),
+    ('4548-4', 'Hemoglobin A1c/Hemoglobin.total in Blood', '%', 4.5, 11),
+    ('2093-3', 'Cholesterol [Mass/volume] in Serum or Plasma', 'mg/dL', 140, 280),
+    ('33914-3', 'Glomerular filtration rate/1.73 sq M.predicted', 'mL/min/{1.73_m2}', 25, 110),
+]
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Maria']
+LAST_NAMES = ['Smith', 'Johnson', 'Garcia', 'Brown', 'Lee', 'Nguyen', 'Miller', 'Davis', 'Lopez', 'Wilson']
+CITIES = [('Boston', 'Massachusetts'), ('Worcester', 'Massachusetts'), ('Springfield', 'Massachusetts'),
+          ('Cambridge', 'Massachusetts'), ('Lowell', 'Massachusetts')]
+
+# Header of each generated CSV, a subset of the Synthea columns
+CSV_COLUMNS = {
+    'patients': ['Id', 'BIRTHDATE', 'DEATHDATE', 'FIRST', 'LAST', 'RACE', 'ETHNICITY', 'GENDER', 'CITY', 'STATE'],
+    'allergies': ['START', 'STOP', 'PATIENT', 'ENCOUNTER', 'CODE', 'SYSTEM', 'DESCRIPTION', 'TYPE', 'CATEGORY'],
+    'conditions': ['START', 'STOP', 'PATIENT', 'ENCOUNTER', 'CODE', 'DESCRIPTION'],
+    'immunizations': ['DATE', 'PATIENT', 'ENCOUNTER', 'CODE', 'DESCRIPTION', 'BASE_COST'],
+    'medications': ['START', 'STOP', 'PATIENT', 'ENCOUNTER', 'CODE', 'DESCRIPTION', 'BASE_COST', 'DISPENSES',
+                    'REASONCODE', 'REASONDESCRIPTION'],
+    'observations': ['DATE', 'PATIENT', 'ENCOUNTER', 'CATEGORY', 'CODE', 'DESCRIPTION', 'VALUE', 'UNITS', 'TYPE'],
+    'procedures': ['START', 'STOP', 'PATIENT', 'ENCOUNTER', 'CODE', 'DESCRIPTION', 'BASE_COST'],
+}
+TODAY = date(2024, 10, 1)  # Fixed, so the generated dates don't depend on when the benchmark runs
+
+
+def _uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def _random_date(rng, start, end):
+    return start + timedelta(days=rng.randrange(max(1, (end - start).days)))
+
+
+def _timestamp(day):
+    return f"{day.isoformat()}T08:00:00Z"
+
+
+def generate_patient_rows(rng):
+    """Rows of every table for one synthetic patient
+
+    Args:
+        rng (random.Random): Seeded random generator
+
+    Returns:
+        dict: table name -> list of rows, in CSV_COLUMNS order
+    """
+    patient_id = _uuid(rng)
+    birthdate = _random_date(rng, date(1935, 1, 1), date(2005, 1, 1))
+    city, state = rng.choice(CITIES)
+    rows = {table: [] for table in CSV_COLUMNS}
+    rows['patients'].append([patient_id, birthdate.isoformat(), '', rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES),
+                             rng.choice(['white', 'black', 'asian', 'hispanic', 'other']),
+                             rng.choice(['nonhispanic', 'hispanic']), rng.choice(['M', 'F']), city, state])
+
+    visits = sorted(_random_date(rng, max(birthdate, date(2010, 1, 1)), TODAY) for _ in range(rng.randint(2, 5)))
+    encounters = [_uuid(rng) for _ in visits]
+
+    for code, description, medication in rng.sample(CONDITIONS, rng.randint(1, 4)):
+        i = rng.randrange(len(visits))
+        start = _timestamp(visits[i])
+        rows['conditions'].append([visits[i].isoformat(), '', patient_id, encounters[i], code, description])
+        stop = '' if rng.random() < 0.7 else _timestamp(_random_date(rng, visits[i], TODAY + timedelta(days=1)))
+        rows['medications'].append([start, stop, patient_id, encounters[i], str(rng.randint(100000, 999999)),
+                                    medication, f"{rng.uniform(5, 500):.2f}", rng.randint(1, 24), code, description])
+
+    for code, description, allergy_type, category in rng.sample(ALLERGIES, rng.choice([0, 0, 1, 1, 2])):
+        rows['allergies'].append([visits[0].isoformat(), '', patient_id, encounters[0], code, 'SNOMED-CT',
+                                  description, allergy_type, category])
+
+    for i, visit in enumerate(visits):
+        code, description = rng.choice(IMMUNIZATIONS)
+        rows['immunizations'].append([_timestamp(visit), patient_id, encounters[i], code, description, '136.00'])
+        code, description = rng.choice(PROCEDURES)
+        rows['procedures'].append([_timestamp(visit), _timestamp(visit), patient_id, encounters[i], code,
+                                   description, f"{rng.uniform(50, 900):.2f}"])
+        for code, description, units, low, high in OBSERVATIONS:
+            rows['observations'].append([_timestamp(visit), patient_id, encounters[i], 'vital-signs', code,
+                                         description, f"{rng.uniform(low, high):.1f}", units, 'numeric'])
+    return rows
+
+
+def generate_patient_csvs(output_dir, n_patients=1000, seed=0):
+    """Writes Synthea-shaped CSVs for n_patients patients, streamed so 100k patients fit in memory
+
+    Args:
+        output_dir (str): Directory to write {table}.csv to, csv_to_db.py reads ./patient_data
+        n_patients (int, optional): Defaults to 1000.
+        seed (int, optional): Defaults to 0.
+
+    Returns:
+        dict: table name -> number of rows written
+    """
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    files = {table: open(os.path.join(output_dir, f'{table}.csv'), 'w', newline='') for table in CSV_COLUMNS}
+    row_counts = dict.fromkeys(CSV_COLUMNS, 0)
+    try:
+        writers = {table: csv.writer(csv_file) for table, csv_file in files.items()}
+        for table, writer in writers.items():
+            writer.writerow(CSV_COLUMNS[table])
+        for _ in range(n_patients):
+            for table, rows in generate_patient_rows(rng).items():
+                writers[table].writerows(rows)
+                row_counts[table] += len(rows)
+    finally:
+        for csv_file in files.values():
+            csv_file.close()
+    return row_counts
+
+
+def generate_trial(rng, index):
+    """One synthetic recruiting trial in the API v2 study format (see trial_api_client.study_to_trial_details)"""
+    (_, target, medication), *others = rng.sample(CONDITIONS, 4)
+    target_name = target.replace(' (disorder)', '').replace(' (finding)', '')
+    age_min, age_max = rng.choice([(18, 65), (18, 75), (40, 80), (50, 85)])
+    excluded = [condition[1].replace(' (disorder)', '').replace(' (finding)', '') for condition in others[:2]]
+    allergy = rng.choice(ALLERGIES)[1]
+    inclusion = [
+        f"Adults aged {age_min} to {age_max} years",
+        f"Confirmed diagnosis of {target_name}",
+        f"Currently treated with {medication.split(' ')[0]} or eligible to start treatment",
+        rng.choice(["Able to provide written informed consent", "Willing to attend all study visits",
+                    "Stable dose of current medications for at least 4 weeks"]),
+    ]
+    exclusion = [
+        f"History of {excluded[0]}",
+        f"Active {excluded[1]} requiring treatment",
+        f"Known {allergy.lower()}",
+        rng.choice(["Pregnant or breastfeeding", "Participation in another interventional trial within 30 days",
+                    "Estimated glomerular filtration rate below 30 mL/min"]),
+    ]
+    criteria = ("Inclusion Criteria:\n\n" + '\n'.join(f"* {line}" for line in inclusion) +
+                "\n\nExclusion Criteria:\n\n" + '\n'.join(f"* {line}" for line in exclusion))
+    intervention = rng.choice(['A Randomized, Double-Blind, Placebo-Controlled Study',
+                               'An Open-Label, Single-Arm Phase 2 Study', 'A Pragmatic Multicenter Trial'])
+    return {
+        "protocolSection": {
+            "identificationModule": {
+                "nctId": f"NCT9{index:07d}",
+                "briefTitle": f"{medication.split(' ')[0].title()} in {target_name}",
+                "officialTitle": f"{intervention} of {medication.split(' ')[0].title()} in Patients With {target_name}"
+            },
+            "descriptionModule": {
+                "briefSummary": f"This study evaluates {medication.split(' ')[0]} in adults with {target_name}."
+            },
+            "conditionsModule": {"conditions": [target_name]},
+            "eligibilityModule": {"eligibilityCriteria": criteria}
+        }
+    }
+
+
+def generate_trial_corpus(output_path, n_trials=500, seed=0):
+    """Writes n_trials synthetic studies to a JSON list
+
+    Args:
+        output_path (str): JSON file, served by fake_llm_server.py --trials
+        n_trials (int, optional): Defaults to 500.
+        seed (int, optional): Defaults to 0.
+
+    Returns:
+        int: number of trials written
+    """
+    rng = random.Random(seed + 1)
+    studies = [generate_trial(rng, i) for i in range(n_trials)]
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as trials_file:
+        json.dump(studies, trials_file)
+    return len(studies)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate synthetic patients and trials for the benchmark")
+    parser.add_argument('--patients', type=int, default=1000)
+    parser.add_argument('--trials', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output-dir', default='./benchmark_runs/data')
+    args = parser.parse_args()
+
+    row_counts = generate_patient_csvs(os.path.join(args.output_dir, 'patient_data'), args.patients, args.seed)
+    print(f"Patient CSVs: {row_counts}")
+    n_trials = generate_trial_corpus(os.path.join(args.output_dir, 'trials.json'), args.trials, args.seed)
+    print(f"Trials: {n_trials}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import os
+import sys
+import glob
+import json
+import math
+import time
+import subprocess
+from collections import defaultdict
+import httpx
+from benchmark_data import generate_patient_csvs, generate_trial_corpus
+from instrumentation import latency_summary
+
+# Offline end to end benchmark of the pipeline, no patient data, network access or LLM keys needed:
+# 1. generate  Synthea-shaped patient CSVs and a synthetic trial corpus (benchmark_data.py)
+# 2. ingest    csv_to_db.py, CSVs -> SQLite and the patient feature table
+# 3. embed     web_scraper_trials.py --fetch-mode http against fake_llm_server.py, trials -> ChromaDB
+# 4. retrieve  find_matching_trial.py --retrieve-only: patient summaries (LLM calls answered by fake_llm_server.py)
+#              and retrieval against the trial embeddings, the candidates are stored as pending pairs
+# 5. adjudicate find_matching_trial.py --patients 0: LLM adjudication of the pending pairs
+# Every step runs as its own process in a fresh work directory with PIPELINE_METRICS=1 (see instrumentation.py).
+# Throughput is items over the time spent in the stage's own work spans (THROUGHPUT_SPANS), so process startup,
+# model loading and, for retrieval, the LLM latency don't count. The wall time is reported next to it.
+# The report is written to <workdir>/benchmark_report.json, pass it back as --baseline to catch regressions.
+# The embedding model must already be in the local Hugging Face cache.
+# Example: python benchmark_pipeline.py --patients 10000 --trials 2000 --match-patients 50 --llm-latency-ms 200
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Spans reported for each stage
+STAGE_SPANS = {
+    "ingest": ['csv_to_db.import_table', 'csv_to_db.refresh_patient_features', 'sqlite.run_query'],
+    "embed": ['embedding.encode', 'embedding.model_encode', 'chromadb.upsert', 'chromadb.query'],
+    "retrieve": ['match.patient', 'match.retrieve', 'snapshot.score_trials', 'chromadb.query', 'chromadb.get',
+                 'llm.chat_completion', 'embedding.encode', 'sqlite.run_query'],
+    "adjudicate": ['match.adjudicate', 'llm.chat_completion', 'chromadb.get'],
+}
+# Spans whose total time is the work of the stage, the throughput is computed over it
+THROUGHPUT_SPANS = {
+    "ingest": ['csv_to_db.import_table', 'csv_to_db.refresh_patient_features'],
+    "embed": ['embedding.encode', 'chromadb.upsert'],
+    "retrieve": ['match.retrieve'],
+    "adjudicate": ['match.adjudicate'],
+}
+
+
+def start_fake_server(port, trials_path, latency_ms, jitter_ms, timeout=30):
+    """Starts fake_llm_server.py in the background and waits until it answers
+
+    Returns:
+        subprocess.Popen: the server process
+    """
+    server = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, 'fake_llm_server.py'), '--port', str(port),
+                               '--trials', trials_path, '--latency-ms', str(latency_ms), '--jitter-ms', str(jitter_ms)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/health").raise_for_status()
+            return server
+        except httpx.HTTPError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"fake_llm_server.py did not start on port {port}")
+
+
+def run_stage(script, args, workdir, env, log_path):
+    """Runs one pipeline script in the work directory
+
+    Returns:
+        float: wall time in seconds
+    """
+    start = time.perf_counter()
+    with open(log_path, 'w') as log_file:
+        subprocess.run([sys.executable, os.path.join(REPO_DIR, script), *args], cwd=workdir, env=env,
+                       stdout=log_file, stderr=subprocess.STDOUT, check=True)
+    return time.perf_counter() - start
+
+
+def _latest_metrics_file(metrics_dir, run_name, suffix):
+    paths = sorted(glob.glob(os.path.join(metrics_dir, f'{run_name}-*{suffix}')))
+    paths = [path for path in paths if suffix != '.json' or not path.endswith('.trace.json')]
+    return paths[-1] if paths else None
+
+
+def stage_metrics(metrics_dir, run_name, span_names):
+    """Span latency percentiles and total time (from the Chrome trace) and counters written by one pipeline run
+
+    Returns:
+        dict: {"spans": {name: latency_summary + total_s}, "counters": {...}}
+    """
+    counters = {}
+    summary_path = _latest_metrics_file(metrics_dir, run_name, '.json')
+    if summary_path:
+        with open(summary_path) as summary_file:
+            counters = json.load(summary_file)['counters']
+
+    durations = defaultdict(list)
+    trace_path = _latest_metrics_file(metrics_dir, run_name, '.trace.json')
+    if trace_path:
+        with open(trace_path) as trace_file:
+            for event in json.load(trace_file)['traceEvents']:
+                if event['name'] in span_names:
+                    durations[event['name']].append(event['dur'] / 1e6)
+    return {"spans": {name: {**latency_summary(durations[name]), "total_s": round(sum(durations[name]), 3)}
+                      for name in span_names if durations[name]},
+            "counters": counters}
+
+
+def _stage_result(wall_s, items, unit, metrics=None, throughput_spans=None):
+    """Throughput of a stage, over the total time of throughput_spans when given, otherwise over the wall time"""
+    result = {"wall_s": round(wall_s, 3), "items": items, "unit": unit,
+              "wall_items_per_s": round(items / wall_s, 2) if wall_s > 0 else None}
+    busy_s = wall_s
+    if throughput_spans:
+        spans = (metrics or {}).get("spans", {})
+        busy_s = sum(spans[name]["total_s"] for name in throughput_spans if name in spans)
+        result["busy_s"] = round(busy_s, 3)
+    result["items_per_s"] = round(items / busy_s, 2) if busy_s > 0 else None
+    if metrics:
+        result.update(metrics)
+    return result
+
+
+def _span_count(metrics, span_name):
+    return metrics["spans"].get(span_name, {}).get("count", 0)
+
+
+def run_benchmark(workdir, n_patients=1000, n_trials=500, match_patients=15, adjudicate=50,
+                  llm_latency_ms=0, llm_jitter_ms=0, port=8089, seed=0):
+    """Generates the synthetic data and runs ingest -> embed -> retrieve -> adjudicate in workdir
+
+    Args:
+        workdir (str): Empty directory the pipeline runs in (databases, ChromaDB, caches, metrics)
+        n_patients (int, optional): Patients to generate and ingest. Defaults to 1000.
+        n_trials (int, optional): Trials to generate and embed. Defaults to 500.
+        match_patients (int, optional): Patients summarized and matched against the trials. Defaults to 15.
+        adjudicate (int, optional): Retrieved (patient, trial) pairs sent to the LLM. Defaults to 50.
+        llm_latency_ms (float, optional): Mean latency of the fake LLM. Defaults to 0.
+        llm_jitter_ms (float, optional): Latency jitter of the fake LLM. Defaults to 0.
+        port (int, optional): Port of the fake server. Defaults to 8089.
+        seed (int, optional): Seed of the synthetic data. Defaults to 0.
+
+    Returns:
+        dict: the benchmark report
+    """
+    os.makedirs(workdir, exist_ok=True)
+    workdir = os.path.abspath(workdir)
+    metrics_dir = os.path.join(workdir, 'metrics')
+    report = {"config": {"patients": n_patients, "trials": n_trials, "match_patients": match_patients,
+                         "adjudicate": adjudicate, "llm_latency_ms": llm_latency_ms,
+                         "llm_jitter_ms": llm_jitter_ms, "seed": seed},
+              "stages": {}}
+
+    start = time.perf_counter()
+    row_counts = generate_patient_csvs(os.path.join(workdir, 'patient_data'), n_patients, seed)
+    trials_path = os.path.join(workdir, 'trials.json')
+    generate_trial_corpus(trials_path, n_trials, seed)
+    report["stages"]["generate"] = _stage_result(time.perf_counter() - start, n_patients, 'patients')
+    report["stages"]["generate"]["rows"] = row_counts
+    print(f"Generated {n_patients} patients ({sum(row_counts.values())} rows) and {n_trials} trials")
+
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.getenv('PYTHONPATH')])),
+               PIPELINE_METRICS='1', PIPELINE_TRACE='1', PIPELINE_METRICS_DIR=metrics_dir,
+               HUGGINGFACE_BASE_URL=f"http://127.0.0.1:{port}",
+               HUGGINGFACE_KEY=os.getenv('HUGGINGFACE_KEY', 'benchmark'),
+               OPENROUTER_URL=f"http://127.0.0.1:{port}/api/v1/chat/completions",
+               OLLAMA_URL=f"http://127.0.0.1:{port}/v1/chat/completions",
+               TOKENIZERS_PARALLELISM='false')
+
+    # Every stage writes its metrics to its own directory, retrieve and adjudicate share the run name
+    def stage_dir(stage):
+        return os.path.join(metrics_dir, stage)
+
+    def stage_env(stage):
+        return dict(env, PIPELINE_METRICS_DIR=stage_dir(stage))
+
+    server = start_fake_server(port, trials_path, llm_latency_ms, llm_jitter_ms)
+    try:
+        print("Ingesting patient CSVs")
+        wall_s = run_stage('csv_to_db.py', [], workdir, stage_env('ingest'), os.path.join(workdir, 'ingest.log'))
+        report["stages"]["ingest"] = _stage_result(wall_s, n_patients, 'patients',
+                                                   stage_metrics(stage_dir('ingest'), 'csv_to_db', STAGE_SPANS["ingest"]),
+                                                   THROUGHPUT_SPANS["ingest"])
+
+        print("Embedding trials")
+        trials_per_page = 100
+        max_pages = math.ceil(n_trials / trials_per_page) + 1  # The scraper fetches pages 1 to max_pages-1
+        wall_s = run_stage('web_scraper_trials.py',
+                           ['--fetch-mode', 'http', '--api-url', f"http://127.0.0.1:{port}/api/v2",
+                            '--max-pages', str(max_pages), '--trials-per-page', str(trials_per_page)],
+                           workdir, stage_env('embed'), os.path.join(workdir, 'embed.log'))
+        report["stages"]["embed"] = _stage_result(wall_s, n_trials, 'trials',
+                                                  stage_metrics(stage_dir('embed'), 'web_scraper_trials',
+                                                                STAGE_SPANS["embed"]),
+                                                  THROUGHPUT_SPANS["embed"])
+
+        # Retrieval and adjudication run as separate processes, so each gets its own wall time and metrics
+        print("Retrieving trials for the patients")
+        wall_s = run_stage('find_matching_trial.py',
+                           ['--patients', str(match_patients), '--adjudicate', '0', '--retrieve-only'],
+                           workdir, stage_env('retrieve'), os.path.join(workdir, 'retrieve.log'))
+        metrics = stage_metrics(stage_dir('retrieve'), 'find_matching_trial', STAGE_SPANS["retrieve"])
+        report["stages"]["retrieve"] = _stage_result(wall_s, _span_count(metrics, 'match.retrieve'), 'patients',
+                                                     metrics, THROUGHPUT_SPANS["retrieve"])
+
+        print("Adjudicating the retrieved pairs")
+        wall_s = run_stage('find_matching_trial.py', ['--patients', '0', '--adjudicate', str(adjudicate)],
+                           workdir, stage_env('adjudicate'), os.path.join(workdir, 'adjudicate.log'))
+        metrics = stage_metrics(stage_dir('adjudicate'), 'find_matching_trial', STAGE_SPANS["adjudicate"])
+        report["stages"]["adjudicate"] = _stage_result(wall_s, _span_count(metrics, 'match.adjudicate'), 'pairs',
+                                                       metrics, THROUGHPUT_SPANS["adjudicate"])
+    finally:
+        server.terminate()
+        server.wait()
+
+    with open(os.path.join(workdir, 'benchmark_report.json'), 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    return report
+
+
+def compare_to_baseline(report, baseline, tolerance=0.2):
+    """Stages whose throughput (items over the time in THROUGHPUT_SPANS) dropped by more than tolerance
+    compared to a baseline report
+
+    Returns:
+        list: (stage, baseline items/s, current items/s) tuples
+    """
+    regressions = []
+    for stage, result in report["stages"].items():
+        baseline_result = baseline.get("stages", {}).get(stage)
+        if not baseline_result or not baseline_result.get("items_per_s") or result.get("items_per_s") is None:
+            continue
+        if result["items_per_s"] < baseline_result["items_per_s"] * (1 - tolerance):
+            regressions.append((stage, baseline_result["items_per_s"], result["items_per_s"]))
+    return regressions
+
+
+def print_report(report):
+    for stage, result in report["stages"].items():
+        print(f"{stage:<10} {result['items']:>7} {result['unit']:<9} {result['items_per_s']:>10} {result['unit']}/s  "
+              f"(wall {result['wall_s']:.2f} s, {result['wall_items_per_s']} {result['unit']}/s)")
+        for name, latency in result.get("spans", {}).items():
+            print(f"    {name:<36} n={latency['count']:<7} p50={latency['p50_ms']}ms "
+                  f"p90={latency['p90_ms']}ms p99={latency['p99_ms']}ms")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Offline end to end benchmark of the matching pipeline")
+    parser.add_argument('--patients', type=int, default=1000)
+    parser.add_argument('--trials', type=int, default=500)
+    parser.add_argument('--match-patients', type=int, default=15)
+    parser.add_argument('--adjudicate', type=int, default=50)
+    parser.add_argument('--llm-latency-ms', type=float, default=0)
+    parser.add_argument('--llm-jitter-ms', type=float, default=0)
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help="Defaults to ./benchmark_runs/<timestamp>")
+    parser.add_argument('--baseline', default=None, help="Report of an earlier run to compare throughput with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed throughput drop vs the baseline")
+    args = parser.parse_args()
+
+    workdir = args.workdir or os.path.join('benchmark_runs', time.strftime('%Y%m%dT%H%M%S'))
+    report = run_benchmark(workdir, args.patients, args.trials, args.match_patients, args.adjudicate,
+                           args.llm_latency_ms, args.llm_jitter_ms, args.port, args.seed)
+    print_report(report)
+    print(f"Report written to {os.path.join(workdir, 'benchmark_report.json')}")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(report, json.load(baseline_file), args.tolerance)
+        for stage, baseline_rate, rate in regressions:
+            print(f"REGRESSION {stage}: {rate}/s vs {baseline_rate}/s in the baseline")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
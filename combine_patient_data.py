@@ -1,7 +1,9 @@
 # This will help consolidate all information regarding a patient
-from sqlalchemy import create_engine, text
+import json
+from sqlalchemy import create_engine, text, inspect
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timezone
+from instrumentation import span, count
 
 # manually identified the relevant CSVs and their columns to create a map of csv:columns
 # This is later used to extract only those columns from those tables from the local SQLite DB.
@@ -15,6 +17,28 @@ important_details_column_map['observations'] = ['category','description','value'
 important_details_column_map['procedures'] = ['description']
 important_details_column_map['patients'] = ['birthdate','gender']
 
+# Materialized per-patient features, one row per patient so a profile is a single indexed lookup.
+# Built by refresh_patient_features() and only rewritten for patients whose source rows changed.
+# Changed patients are tracked in SQLite: triggers on the source tables mark a patient dirty on any edit of
+# its rows, and a CSV re-import (replace_tracked_table) diffs the new table against the old one.
+FEATURE_TABLE = 'patient_features'
+FEATURE_SOURCE_TABLES = [table for table in important_details_column_map if table != 'patients']
+TRACKED_TABLES = list(important_details_column_map)
+DIRTY_TABLE = 'patient_features_dirty'
+PATIENT_DB_URL = 'sqlite:///patient_data.db'
+
+_engines = {}
+# Set once the feature table was found, so profile lookups don't inspect the schema every time
+_has_feature_table = False
+
+
+def get_engine(db_url=PATIENT_DB_URL):
+    """Returns a (cached) SQLAlchemy engine for the patient database"""
+    if db_url not in _engines:
+        _engines[db_url] = create_engine(db_url)
+    return _engines[db_url]
+
+
 
 def run_query(query):
     """Runs a given SQL query on the patient data stored in SQLite DB
@@ -25,13 +49,15 @@ def run_query(query):
     Returns:
         list: matched output rows as a list
     """
-    engine = create_engine('sqlite:///patient_data.db')
-    connection = engine.connect()
+    connection = get_engine().connect()
     rows = []
+    count('sqlite.queries')
     try:
         sql_query = text(query)
-        result = connection.execute(sql_query)
-        rows = result.fetchall()
+        with span('sqlite.run_query'):
+            result = connection.execute(sql_query)
+            rows = result.fetchall()
+        count('sqlite.rows', len(rows))
         
     except Exception as e:
         print("Error: ", e)
@@ -134,8 +160,275 @@ def calculate_age(date_string):
         age -= 1
     return age
 
+def feature_rows_query(specific_table):
+    """Set-based version of get_patient_per_table_by_id: the feature rows of a table for every patient in the
+    temp.changed_patients table at once, in the same row order as the per-patient query.
+    Observations are limited to the latest date, medications to active ones (no stop date)
+    and conditions/allergies are de-duplicated.
+
+    Args:
+        specific_table (str): The name of the table to fetch rows from
+
+    Returns:
+        str: SQL query returning the patient ID followed by the mapped columns
+    """
+    columns = important_details_column_map[specific_table]
+    SELECT_TABLE_COLUMNS = ', '.join(map(lambda x: f'{"a."}{x}', columns))
+    changed_patients_filter = "a.patient IN (SELECT patient_id FROM temp.changed_patients)"
+    if specific_table == "observations":
+        return f"""
+            SELECT a.patient, {SELECT_TABLE_COLUMNS}
+            FROM observations a
+            JOIN (SELECT patient, MAX(date) AS max_date
+                  FROM observations
+                  WHERE patient IN (SELECT patient_id FROM temp.changed_patients)
+                  GROUP BY patient) latest
+                ON a.patient = latest.patient AND a.date = latest.max_date
+            ORDER BY a.rowid;
+        """
+    if specific_table == "medications":
+        return f"""
+            SELECT a.patient, {SELECT_TABLE_COLUMNS}
+            FROM medications a
+            WHERE {changed_patients_filter} AND a.stop IS NULL
+            ORDER BY a.rowid;
+        """
+    if specific_table in ("conditions", "allergies"):
+        return f"""
+            SELECT a.patient, {SELECT_TABLE_COLUMNS}
+            FROM {specific_table} a
+            WHERE {changed_patients_filter}
+            GROUP BY a.patient, {SELECT_TABLE_COLUMNS}
+            ORDER BY MIN(a.rowid);
+        """
+    return f"""
+        SELECT a.patient, {SELECT_TABLE_COLUMNS}
+        FROM {specific_table} a
+        WHERE {changed_patients_filter}
+        ORDER BY a.rowid;
+    """
+
+def tracked_columns(specific_table):
+    """Columns of a table the features are built from, the patient column first.
+    A change in any of them marks the patient for the next feature refresh.
+
+    Args:
+        specific_table (str): The name of the table
+
+    Returns:
+        list: column names
+    """
+    if specific_table == 'patients':
+        return ['id'] + important_details_column_map['patients']
+    columns = ['patient'] + list(important_details_column_map[specific_table])
+    if specific_table == "observations":
+        columns.append('date')
+    return columns
+
+def create_dirty_table(connection):
+    connection.execute(text(f"CREATE TABLE IF NOT EXISTS {DIRTY_TABLE} (patient_id TEXT PRIMARY KEY);"))
+
+def install_change_triggers(connection, specific_table):
+    """Creates the triggers marking a patient dirty on every insert, update or delete of its rows in a table,
+    so edits made directly in SQLite are picked up by the next refresh without scanning the tables.
+
+    Args:
+        connection (sqlalchemy.engine.Connection): Connection to the patient database
+        specific_table (str): The name of the table
+
+    Returns:
+        bool: True if the triggers were missing, i.e. the table was created without change tracking
+    """
+    patient_column = tracked_columns(specific_table)[0]
+    existing_triggers = {row[0] for row in connection.execute(text(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = :table;"), {"table": specific_table})}
+    created = False
+    for event, row_names in (('INSERT', ['NEW']), ('DELETE', ['OLD']), ('UPDATE', ['OLD', 'NEW'])):
+        trigger_name = f'trg_{specific_table}_{event.lower()}_dirty'
+        if trigger_name in existing_triggers:
+            continue
+        mark_dirty = ' '.join(f"INSERT OR IGNORE INTO {DIRTY_TABLE} (patient_id) VALUES ({row_name}.{patient_column});"
+                              for row_name in row_names)
+        connection.execute(text(f"CREATE TRIGGER {trigger_name} AFTER {event} ON {specific_table} BEGIN {mark_dirty} END;"))
+        created = True
+    return created
+
+def replace_tracked_table(specific_table, import_table, db_url=PATIENT_DB_URL):
+    """Swaps a freshly imported copy of a table in, marking the patients whose tracked rows differ from the current
+    table as dirty. The diff runs in SQLite (rows grouped over the tracked columns, with their counts), so
+    re-importing unchanged CSVs leaves the features alone.
+
+    Args:
+        specific_table (str): The name of the table to replace
+        import_table (str): The name of the imported table, renamed to specific_table
+        db_url (str, optional): SQLAlchemy URL of the patient database. Defaults to PATIENT_DB_URL.
+
+    Returns:
+        int: Number of patients newly marked dirty
+    """
+    engine = get_engine(db_url)
+    columns = tracked_columns(specific_table)
+    patient_column = columns[0]
+    with engine.begin() as connection:
+        create_dirty_table(connection)
+        dirty_before = connection.execute(text(f"SELECT COUNT(*) FROM {DIRTY_TABLE};")).scalar()
+        schema = inspect(connection)
+        current_columns = ({column['name'] for column in schema.get_columns(specific_table)}
+                           if schema.has_table(specific_table) else set())
+        import_columns = {column['name'] for column in schema.get_columns(import_table)}
+        if set(columns) <= current_columns and set(columns) <= import_columns:
+            # One grouping pass over both versions: a row whose copies don't cancel out was added or removed
+            selected = ', '.join(columns)
+            connection.execute(text(f"""
+                INSERT OR IGNORE INTO {DIRTY_TABLE} (patient_id)
+                SELECT DISTINCT {patient_column} FROM (
+                    SELECT {selected}, 1 AS side FROM {import_table}
+                    UNION ALL
+                    SELECT {selected}, -1 AS side FROM {specific_table}
+                )
+                GROUP BY {selected}
+                HAVING SUM(side) != 0;
+            """))
+        else:
+            # New table or another layout, every patient in either version changed
+            for table, table_columns in ((import_table, import_columns), (specific_table, current_columns)):
+                if patient_column in table_columns:
+                    connection.execute(text(f"""
+                        INSERT OR IGNORE INTO {DIRTY_TABLE} (patient_id) SELECT DISTINCT {patient_column} FROM {table};
+                    """))
+        connection.execute(text(f"DROP TABLE IF EXISTS {specific_table};"))
+        connection.execute(text(f"ALTER TABLE {import_table} RENAME TO {specific_table};"))
+        if patient_column in import_columns:
+            connection.execute(text(
+                f"CREATE INDEX IF NOT EXISTS idx_{specific_table}_{patient_column} ON {specific_table} ({patient_column});"))
+            install_change_triggers(connection, specific_table)
+        dirty_after = connection.execute(text(f"SELECT COUNT(*) FROM {DIRTY_TABLE};")).scalar()
+    return dirty_after - dirty_before
+
+def refresh_patient_features(full=False, db_url=PATIENT_DB_URL):
+    """Builds or incrementally refreshes the patient_features table in one set-based pass per source table.
+    Only patients that are new or marked dirty (by the change triggers or replace_tracked_table) are recomputed
+    and rewritten, patients that disappeared from the patients table are removed.
+
+    Args:
+        full (bool, optional): Recompute every patient. Defaults to False.
+        db_url (str, optional): SQLAlchemy URL of the patient database. Defaults to PATIENT_DB_URL.
+
+    Returns:
+        int: Number of patients that were (re)computed
+    """
+    engine = get_engine(db_url)
+    existing_tables = set(inspect(engine).get_table_names())
+    source_tables = [table for table in FEATURE_SOURCE_TABLES if table in existing_tables]
+
+    with engine.begin() as connection:
+        connection.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {FEATURE_TABLE} (
+                patient_id TEXT PRIMARY KEY,
+                birthdate TEXT,
+                gender TEXT,
+                age INTEGER,
+                {', '.join(f'{table} TEXT' for table in FEATURE_SOURCE_TABLES)},
+                updated_at TEXT
+            );
+        """))
+        create_dirty_table(connection)
+        for table in source_tables:
+            connection.execute(text(f"CREATE INDEX IF NOT EXISTS idx_{table}_patient ON {table} (patient);"))
+        for table in source_tables + ['patients']:
+            # Without triggers the table was written untracked (e.g. replaced by hand), so any of its patients
+            # may have changed
+            if install_change_triggers(connection, table) and not full:
+                connection.execute(text(f"""
+                    INSERT OR IGNORE INTO {DIRTY_TABLE} (patient_id)
+                    SELECT DISTINCT {tracked_columns(table)[0]} FROM {table};
+                """))
+
+        removed = connection.execute(text(f"""
+            DELETE FROM {FEATURE_TABLE} WHERE patient_id NOT IN (SELECT id FROM patients);
+        """)).rowcount
+        connection.execute(text("CREATE TEMP TABLE IF NOT EXISTS changed_patients (patient_id TEXT PRIMARY KEY);"))
+        connection.execute(text("DELETE FROM temp.changed_patients;"))
+        changed_filter = "" if full else f"""
+            WHERE id IN (SELECT patient_id FROM {DIRTY_TABLE})
+               OR id NOT IN (SELECT patient_id FROM {FEATURE_TABLE})"""
+        connection.execute(text(f"""
+            INSERT OR IGNORE INTO temp.changed_patients (patient_id) SELECT id FROM patients {changed_filter};
+        """))
+        connection.execute(text(f"DELETE FROM {DIRTY_TABLE};"))
+        patients = {row[0]: (row[1], row[2]) for row in connection.execute(text("""
+            SELECT p.id, p.birthdate, p.gender FROM patients p JOIN temp.changed_patients c ON p.id = c.patient_id;
+        """))}
+        changed_ids = list(patients)
+        if not changed_ids:
+            connection.execute(text("DROP TABLE temp.changed_patients;"))
+            print(f"Patient features: 0 patients refreshed, {removed} removed")
+            return 0
+
+        features = {p_id: defaultdict(list) for p_id in changed_ids}
+        for table in source_tables:
+            for row in connection.execute(text(feature_rows_query(table))):
+                features[row[0]][table].append(list(row[1:]))
+
+        updated_at = datetime.now(timezone.utc).isoformat()
+        feature_rows = []
+        for p_id in changed_ids:
+            birthdate, gender = patients[p_id]
+            feature_row = {
+                "patient_id": p_id,
+                "birthdate": birthdate,
+                "gender": gender,
+                "age": calculate_age(birthdate) if birthdate else None,
+                "updated_at": updated_at
+            }
+            for table in FEATURE_SOURCE_TABLES:
+                feature_row[table] = json.dumps(features[p_id][table])
+            feature_rows.append(feature_row)
+
+        columns = ['patient_id', 'birthdate', 'gender', 'age'] + FEATURE_SOURCE_TABLES + ['updated_at']
+        connection.execute(text(f"""
+            INSERT OR REPLACE INTO {FEATURE_TABLE} ({', '.join(columns)})
+            VALUES ({', '.join(f':{column}' for column in columns)});
+        """), feature_rows)
+        connection.execute(text("DROP TABLE temp.changed_patients;"))
+
+    print(f"Patient features: {len(changed_ids)} patients refreshed, {removed} removed")
+    return len(changed_ids)
+
+def get_patient_features(p_id):
+    """Reads a patient's materialized features with a single primary key lookup
+
+    Args:
+        p_id (str): Patient ID
+
+    Returns:
+        tuple: (birthdate, gender, profile dict) or None if the feature table or the patient is missing
+    """
+    global _has_feature_table
+    if not _has_feature_table:
+        if not inspect(get_engine()).has_table(FEATURE_TABLE):
+            return None
+        _has_feature_table = True
+    query_result = run_query(f"""
+            SELECT birthdate, gender, {', '.join(FEATURE_SOURCE_TABLES)}
+            FROM {FEATURE_TABLE}
+            WHERE patient_id = '{p_id}';
+            """)
+    if not query_result:
+        return None
+    birthdate, gender = query_result[0][0], query_result[0][1]
+    patient_profile = defaultdict()
+    for key, value in zip(FEATURE_SOURCE_TABLES, query_result[0][2:]):
+        rows = [tuple(row) for row in json.loads(value)]
+        # Keep the shape of the per-table LEFT JOIN queries, which return a row of NULLs when there's no data
+        if not rows and key != 'observations':
+            rows = [(None,) * len(important_details_column_map[key])]
+        patient_profile[key] = rows
+    return birthdate, gender, patient_profile
+
 def create_patient_profile(p_id):
-    """Generates a patient profile combining all important fields
+    """Generates a patient profile combining all important fields.
+    Read from the patient_features table when it has been built, otherwise queried table by table.
 
     Args:
         p_id (str): Patient ID
@@ -143,6 +436,16 @@ def create_patient_profile(p_id):
     Returns:
         dict: dict with the details, age, gender, ID
     """    
+    patient_features = get_patient_features(p_id)
+    if patient_features is not None:
+        patient_bday, gender, patient_profile = patient_features
+        return {f"{p_id}":{
+                            "age": calculate_age(patient_bday),
+                            "gender": gender,
+                            "profile":patient_profile
+                        }
+                }
+
     patient_profile = defaultdict()
     patient_details = get_patient_details(p_id)
     patient_bday = patient_details[0][0]
@@ -1,6 +1,7 @@
 import chromadb
-from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
+from embedding_cache import get_cached_embedding_model
+from instrumentation import span
 
 def get_or_create_collection(client, collection_name):
     """Helps to create a ChromaDB collection if it doesn't already exist
@@ -32,7 +33,9 @@ def init():
     # Separate collections for inclusion and exclusion criteria
     inclusion_collection = get_or_create_collection(client, "inclusion_criteria")
     exclusion_collection = get_or_create_collection(client, "exclusion_criteria")
-    model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+    # Backend (torch / torch-int8 / onnx / onnx-int8) is picked from the EMBEDDING_BACKEND env variable.
+    # The model is wrapped with the on-disk embedding cache, so texts embedded before are never re-encoded.
+    model = get_cached_embedding_model()
     return inclusion_collection, exclusion_collection, model
 
 def embed_and_add_single_entry(collection, model, data, id, study_title=None):
@@ -49,18 +52,20 @@ def embed_and_add_single_entry(collection, model, data, id, study_title=None):
         None
     """
 # Sample data (embedding and metadata)
-    embedding = model.encode(data, convert_to_tensor=False).tolist()
+    with span('embedding.encode'):
+        embedding = model.encode(data, convert_to_tensor=False).tolist()
     if study_title is not None:
         metadata = {"trial_id": id, "study_title": study_title}
     else:
         metadata = {"patient_id": id}
 
-    collection.upsert(
-        embeddings=[embedding],
-        documents=[data],
-        metadatas=[metadata],
-        ids=[id]
-    )
+    with span('chromadb.upsert'):
+        collection.upsert(
+            embeddings=[embedding],
+            documents=[data],
+            metadatas=[metadata],
+            ids=[id]
+        )
     # if 'ids' in response:
     #     print(f"Successfully added trial ID: {id} with embedding.")
     # else:
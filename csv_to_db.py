@@ -1,6 +1,8 @@
 import os
 from sqlalchemy import create_engine, inspect
 import pandas as pd
+from combine_patient_data import refresh_patient_features, replace_tracked_table, TRACKED_TABLES
+from instrumentation import span, export_run
 
 # File contains code to convert the given patient CSV files into an RDB stored in local SQLite.
 
@@ -21,23 +23,37 @@ for filename in os.listdir(csv_directory):
         # Get the table name from the file name (without extension)
         table_name = os.path.splitext(filename)[0].lower()
         
-        # Read CSV file
-        df = pd.read_csv(os.path.join(csv_directory, filename))
-        
-        # Clean column names
-        df.columns = [clean_column_name(col) for col in df.columns]
-        
-        # Create table and insert data
-        df.to_sql(table_name, engine, if_exists='replace', index=False)
+        with span('csv_to_db.import_table'):
+            # Read CSV file
+            df = pd.read_csv(os.path.join(csv_directory, filename))
+            
+            # Clean column names
+            df.columns = [clean_column_name(col) for col in df.columns]
+            
+            # Create table and insert data
+            if table_name in TRACKED_TABLES:
+                # Imported next to the current table and swapped in, patients whose rows differ are marked
+                # for the feature refresh below
+                df.to_sql(f'{table_name}_import', engine, if_exists='replace', index=False)
+                replace_tracked_table(table_name, f'{table_name}_import', f'sqlite:///{db_name}')
+            else:
+                df.to_sql(table_name, engine, if_exists='replace', index=False)
 
         print(f"Imported {filename} into {table_name} table")
 
 print("All CSV files have been imported into the database.")
 
+# Rebuild the materialized patient features, only for patients whose rows changed in this import
+with span('csv_to_db.refresh_patient_features'):
+    refresh_patient_features()
+
 # Print table structures
 inspector = inspect(engine)
 
 for table_name in inspector.get_table_names():
     print(f"\nTable: {table_name}")
     for column in inspector.get_columns(table_name):
-        print(f"  {column['name']}: {column['type']}")
\ No newline at end of file
+        print(f"  {column['name']}: {column['type']}")
+
+# Per-run timings and counters, only written when PIPELINE_METRICS=1
+export_run('csv_to_db')
@@ -0,0 +1,292 @@
+import os
+import sys
+import time
+import numpy as np
+
+# Pluggable embedding backends for the MiniLM sentence encoder.
+# Every backend exposes the same `encode` call as SentenceTransformer, so callers
+# (init() in create_clinical_trial_embeddings, find_matching_trial) don't care which one is used.
+# Pick one with the EMBEDDING_BACKEND env variable (or .env), defaults to plain fp32 torch.
+
+EMBEDDING_MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+AVAILABLE_BACKENDS = ('torch', 'torch-int8', 'onnx', 'onnx-int8')
+ONNX_MODEL_DIR = './onnx_models'
+MAX_SEQ_LENGTH = 256  # Same as the max_seq_length shipped with all-MiniLM-L6-v2
+
+
+class TorchEmbeddingBackend:
+    """Reference backend, the full fp32 SentenceTransformer model"""
+
+    backend_name = 'torch'
+
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME):
+        from sentence_transformers import SentenceTransformer
+        self.model_name = model_name
+        self.model = SentenceTransformer(model_name, device='cpu')
+
+    def encode(self, sentences, batch_size=32, convert_to_tensor=False, **kwargs):
+        """Embed a single text or a list of texts
+
+        Args:
+            sentences (str or list): Text(s) to embed
+            batch_size (int, optional): Number of texts per forward pass. Defaults to 32.
+            convert_to_tensor (bool, optional): Kept for SentenceTransformer compatibility. Defaults to False.
+
+        Returns:
+            np.ndarray: 1D vector for a single text, 2D (n, dim) array for a list of texts
+        """
+        return self.model.encode(sentences, batch_size=batch_size, convert_to_tensor=convert_to_tensor, **kwargs)
+
+
+class TorchInt8EmbeddingBackend(TorchEmbeddingBackend):
+    """Same SentenceTransformer model with its Linear layers dynamically quantized to int8"""
+
+    backend_name = 'torch-int8'
+
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME):
+        import torch
+        super().__init__(model_name)
+        self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class OnnxEmbeddingBackend:
+    """Runs the MiniLM transformer through ONNX Runtime on CPU, with the mean pooling and
+    normalization of the SentenceTransformer pipeline done in numpy.
+    The ONNX graph is exported once and reused from ONNX_MODEL_DIR.
+    """
+
+    backend_name = 'onnx'
+
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME, quantize=False):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+        self.model_name = model_name
+        self.quantize = quantize
+        if quantize:
+            self.backend_name = 'onnx-int8'
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model_path = export_onnx_model(model_name, quantize=quantize)
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, session_options, providers=['CPUExecutionProvider'])
+        self.input_names = [session_input.name for session_input in self.session.get_inputs()]
+
+    def encode(self, sentences, batch_size=32, convert_to_tensor=False, **kwargs):
+        """Embed a single text or a list of texts
+
+        Args:
+            sentences (str or list): Text(s) to embed
+            batch_size (int, optional): Number of texts per forward pass. Defaults to 32.
+            convert_to_tensor (bool, optional): Ignored, numpy arrays are always returned. Defaults to False.
+
+        Returns:
+            np.ndarray: 1D vector for a single text, 2D (n, dim) array for a list of texts
+        """
+        single_input = isinstance(sentences, str)
+        if single_input:
+            sentences = [sentences]
+
+        # Sort by length so every batch is padded as little as possible, like SentenceTransformer does
+        order = np.argsort([-len(sentence) for sentence in sentences])
+        embeddings = [None] * len(sentences)
+        for start in range(0, len(sentences), batch_size):
+            batch_index = order[start:start + batch_size]
+            batch_embeddings = self._encode_batch([sentences[i] for i in batch_index])
+            for i, embedding in zip(batch_index, batch_embeddings):
+                embeddings[i] = embedding
+
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(sentences), -1)
+        return embeddings[0] if single_input else embeddings
+
+    def _encode_batch(self, batch):
+        tokens = self.tokenizer(batch, padding=True, truncation=True,
+                                max_length=MAX_SEQ_LENGTH, return_tensors='np')
+        feed = {name: tokens[name].astype(np.int64) for name in self.input_names}
+        token_embeddings = self.session.run(None, feed)[0]
+        # Mean pooling over the non-padding tokens, followed by L2 normalization
+        attention_mask = tokens['attention_mask'][..., None].astype(np.float32)
+        summed = (token_embeddings * attention_mask).sum(axis=1)
+        counts = np.clip(attention_mask.sum(axis=1), 1e-9, None)
+        pooled = summed / counts
+        norms = np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled / norms
+
+
+def export_onnx_model(model_name=EMBEDDING_MODEL_NAME, quantize=False):
+    """Exports the transformer of the given model to ONNX (and optionally quantizes it to int8)
+    if it hasn't been exported already.
+
+    Args:
+        model_name (str, optional): HuggingFace model name. Defaults to EMBEDDING_MODEL_NAME.
+        quantize (bool, optional): Whether to return the int8 quantized graph. Defaults to False.
+
+    Returns:
+        str: Path to the .onnx file
+    """
+    model_dir = os.path.join(ONNX_MODEL_DIR, model_name.replace('/', '__'))
+    fp32_path = os.path.join(model_dir, 'model.onnx')
+    int8_path = os.path.join(model_dir, 'model_int8.onnx')
+
+    if not os.path.exists(fp32_path):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+        os.makedirs(model_dir, exist_ok=True)
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModel.from_pretrained(model_name)
+        model.eval()
+        dummy = tokenizer(["clinical trial matching"], return_tensors='pt')
+        input_names = ['input_ids', 'attention_mask', 'token_type_ids']
+        dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+        dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+        with torch.no_grad():
+            torch.onnx.export(model,
+                              tuple(dummy[name] for name in input_names),
+                              fp32_path,
+                              input_names=input_names,
+                              output_names=['last_hidden_state'],
+                              dynamic_axes=dynamic_axes,
+                              opset_version=14)
+        print(f"Exported {model_name} to {fp32_path}")
+
+    if not quantize:
+        return fp32_path
+
+    if not os.path.exists(int8_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+        print(f"Quantized {fp32_path} to {int8_path}")
+    return int8_path
+
+
+def get_embedding_model(backend=None, model_name=EMBEDDING_MODEL_NAME):
+    """Creates the embedding model for the given backend
+
+    Args:
+        backend (str, optional): One of AVAILABLE_BACKENDS. Defaults to the EMBEDDING_BACKEND env variable or 'torch'.
+        model_name (str, optional): HuggingFace model name. Defaults to EMBEDDING_MODEL_NAME.
+
+    Returns:
+        embedding model: object with a SentenceTransformer-like `encode` method
+    """
+    if backend is None:
+        from dotenv import load_dotenv
+        load_dotenv()
+        backend = os.getenv('EMBEDDING_BACKEND', 'torch')
+
+    if backend == 'torch':
+        return TorchEmbeddingBackend(model_name)
+    if backend == 'torch-int8':
+        return TorchInt8EmbeddingBackend(model_name)
+    if backend == 'onnx':
+        return OnnxEmbeddingBackend(model_name)
+    if backend == 'onnx-int8':
+        return OnnxEmbeddingBackend(model_name, quantize=True)
+    raise ValueError(f"Unknown embedding backend '{backend}', expected one of {AVAILABLE_BACKENDS}")
+
+
+def cosine_similarity_matrix(embeddings_a, embeddings_b):
+    """Cosine similarity between every row of embeddings_a and every row of embeddings_b
+
+    Returns:
+        np.ndarray: (len(a), len(b)) matrix of cosine scores
+    """
+    a = np.asarray(embeddings_a, dtype=np.float32)
+    b = np.asarray(embeddings_b, dtype=np.float32)
+    a = a / np.clip(np.linalg.norm(a, axis=1, keepdims=True), 1e-12, None)
+    b = b / np.clip(np.linalg.norm(b, axis=1, keepdims=True), 1e-12, None)
+    return a @ b.T
+
+
+def check_parity(reference_model, candidate_model, texts, tolerance=0.02):
+    """Compares the cosine scores produced by a candidate backend against the reference encoder.
+    Patient summaries are scored against trial criteria with cosine similarity, so this is the number that
+    needs to stay the same, not the raw vector values.
+
+    Args:
+        reference_model (embedding model): Usually the fp32 torch backend
+        candidate_model (embedding model): The backend to validate
+        texts (list): Texts to embed with both models
+        tolerance (float, optional): Maximum allowed absolute difference in any cosine score. Defaults to 0.02.
+
+    Returns:
+        dict: max/mean difference of the pairwise cosine scores, the minimum reference-vs-candidate
+        cosine per text and whether the candidate is within tolerance
+    """
+    reference_embeddings = reference_model.encode(texts)
+    candidate_embeddings = candidate_model.encode(texts)
+    score_diff = np.abs(cosine_similarity_matrix(reference_embeddings, reference_embeddings)
+                        - cosine_similarity_matrix(candidate_embeddings, candidate_embeddings))
+    self_similarity = np.diag(cosine_similarity_matrix(reference_embeddings, candidate_embeddings))
+    return {
+        "max_score_diff": float(score_diff.max()),
+        "mean_score_diff": float(score_diff.mean()),
+        "min_self_similarity": float(self_similarity.min()),
+        "passed": bool(score_diff.max() <= tolerance)
+    }
+
+
+def benchmark_throughput(model, texts, batch_size=32, repeats=3):
+    """Measures encoding throughput of a backend
+
+    Args:
+        model (embedding model): The backend to benchmark
+        texts (list): Texts to encode
+        batch_size (int, optional): Batch size passed to encode. Defaults to 32.
+        repeats (int, optional): Number of timed runs, the best one is reported. Defaults to 3.
+
+    Returns:
+        float: texts encoded per second
+    """
+    model.encode(texts[:batch_size], batch_size=batch_size)  # Warm up
+    best_time = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.encode(texts, batch_size=batch_size)
+        best_time = min(best_time, time.perf_counter() - start)
+    return len(texts) / best_time
+
+
+def sample_texts(n_texts):
+    """Builds n_texts clinical looking sentences of varying length for parity checks and benchmarks"""
+    conditions = ['type 2 diabetes mellitus', 'essential hypertension', 'chronic kidney disease stage 3',
+                  'asthma', 'major depressive disorder', 'non-small cell lung cancer', 'atrial fibrillation',
+                  'rheumatoid arthritis', 'obesity', 'chronic obstructive pulmonary disease']
+    medications = ['metformin 500 MG', 'lisinopril 10 MG', 'albuterol inhaler', 'sertraline 50 MG',
+                   'apixaban 5 MG', 'methotrexate 2.5 MG', 'atorvastatin 20 MG']
+    texts = []
+    for i in range(n_texts):
+        condition = conditions[i % len(conditions)]
+        medication = medications[i % len(medications)]
+        sentence = (f"Patient aged {18 + i % 70} diagnosed with {condition}, currently taking {medication}. "
+                    f"Adults with a confirmed diagnosis of {condition} who are able to give informed consent. ")
+        texts.append(sentence * (1 + i % 4))
+    return texts
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Check parity and throughput of an embedding backend")
+    parser.add_argument('--backend', default='onnx-int8', choices=AVAILABLE_BACKENDS)
+    parser.add_argument('--texts', type=int, default=256, help="Number of texts to embed")
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--tolerance', type=float, default=0.02)
+    args = parser.parse_args()
+
+    texts = sample_texts(args.texts)
+    reference_model = get_embedding_model('torch')
+    candidate_model = reference_model if args.backend == 'torch' else get_embedding_model(args.backend)
+
+    parity = check_parity(reference_model, candidate_model, texts, tolerance=args.tolerance)
+    print(f"Parity of '{args.backend}' against 'torch': ", parity)
+    reference_throughput = benchmark_throughput(reference_model, texts, batch_size=args.batch_size)
+    candidate_throughput = benchmark_throughput(candidate_model, texts, batch_size=args.batch_size)
+    print(f"torch: {reference_throughput:.1f} texts/sec")
+    print(f"{args.backend}: {candidate_throughput:.1f} texts/sec "
+          f"({candidate_throughput / reference_throughput:.2f}x)")
+    if not parity["passed"]:
+        # Non-zero exit so the parity check can gate a switch of EMBEDDING_BACKEND
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
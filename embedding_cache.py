@@ -0,0 +1,213 @@
+import os
+import json
+import hashlib
+import numpy as np
+from instrumentation import span, count
+
+try:
+    import fcntl
+except ImportError:  # Windows, appends are not locked across processes
+    fcntl = None
+
+# On-disk cache of embeddings, keyed by (model, hash of the normalized text).
+# Vectors are appended as raw float32 rows to `vectors.f32` and read back through a memory map,
+# `index.tsv` maps each key to its row. Both files are append only, so a re-index after a ChromaDB wipe
+# only has to read the vectors back instead of running the model again.
+
+EMBEDDING_CACHE_DIR = './embedding_cache'
+
+
+def normalize_text(text):
+    """Collapses all whitespace so that re-scraped or re-formatted copies of a text share a cache entry"""
+    return ' '.join(text.split())
+
+
+def text_hash(text):
+    """sha256 hex digest of the normalized text"""
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+def model_key(model):
+    """Identifies the vectors an embedding model produces, e.g. 'sentence-transformers/all-MiniLM-L6-v2@onnx-int8'"""
+    return f"{model.model_name}@{model.backend_name}"
+
+
+class EmbeddingCache:
+    """Append-only memory-mapped embedding cache for a single model
+
+    Args:
+        model_key (str): Identifies the model the vectors come from, e.g. 'sentence-transformers/all-MiniLM-L6-v2@torch'
+        cache_dir (str, optional): Root directory of the cache. Defaults to EMBEDDING_CACHE_DIR.
+    """
+
+    def __init__(self, model_key, cache_dir=EMBEDDING_CACHE_DIR):
+        self.model_key = model_key
+        self.path = os.path.join(cache_dir, model_key.replace('/', '__').replace('@', '--'))
+        os.makedirs(self.path, exist_ok=True)
+        self.vectors_path = os.path.join(self.path, 'vectors.f32')
+        self.index_path = os.path.join(self.path, 'index.tsv')
+        self.meta_path = os.path.join(self.path, 'meta.json')
+        self.hits = 0
+        self.misses = 0
+        self.dim = None
+        self.index = {}
+        self._vectors = None
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path) as meta_file:
+                self.dim = json.load(meta_file)['dim']
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index_file:
+                for line in index_file:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) == 2:  # Skip a partially written last line
+                        self.index[parts[0]] = int(parts[1])
+
+    def __len__(self):
+        return len(self.index)
+
+    def _row_bytes(self):
+        return self.dim * np.dtype(np.float32).itemsize
+
+    def _vectors_map(self, row):
+        """Memory map of the vectors file, re-mapped when the row asked for was appended after the last mapping"""
+        if self._vectors is None or row >= self._vectors.shape[0]:
+            n_rows = os.path.getsize(self.vectors_path) // self._row_bytes()
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(n_rows, self.dim))
+        return self._vectors
+
+    def get(self, text):
+        """Looks up the embedding of a text
+
+        Args:
+            text (str): The text that was embedded
+
+        Returns:
+            np.ndarray: The cached float32 vector, or None on a cache miss
+        """
+        row = self.index.get(text_hash(text))
+        if row is None:
+            self.misses += 1
+            count('embedding_cache.misses')
+            return None
+        self.hits += 1
+        count('embedding_cache.hits')
+        return np.array(self._vectors_map(row)[row])
+
+    def put_many(self, texts, vectors):
+        """Appends the embeddings of the given texts to the cache. Texts already cached are skipped.
+
+        Args:
+            texts (list): Texts that were embedded
+            vectors (np.ndarray): (len(texts), dim) embeddings of those texts
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+            with open(self.meta_path, 'w') as meta_file:
+                json.dump({"model": self.model_key, "dim": self.dim}, meta_file)
+
+        new_entries = {}
+        for text, vector in zip(texts, vectors):
+            key = text_hash(text)
+            if key not in self.index and key not in new_entries:
+                new_entries[key] = vector
+        if not new_entries:
+            return
+
+        with open(self.index_path, 'a') as index_file:
+            if fcntl is not None:
+                fcntl.flock(index_file, fcntl.LOCK_EX)
+            try:
+                with open(self.vectors_path, 'ab') as vectors_file:
+                    # Drop a torn row left behind by an interrupted write before appending
+                    size = vectors_file.tell()
+                    if size % self._row_bytes():
+                        vectors_file.truncate(size - size % self._row_bytes())
+                        vectors_file.seek(0, os.SEEK_END)
+                    first_row = vectors_file.tell() // self._row_bytes()
+                    vectors_file.write(np.stack(list(new_entries.values())).tobytes())
+                # The index is only written once the vectors are on disk, so every key points at a full row
+                lines = [f"{key}\t{first_row + i}\n" for i, key in enumerate(new_entries)]
+                index_file.write(''.join(lines))
+                index_file.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(index_file, fcntl.LOCK_UN)
+
+        for i, key in enumerate(new_entries):
+            self.index[key] = first_row + i
+
+    def hit_rate(self):
+        """Share of lookups served from the cache since it was opened"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """Returns a dict with the cache size, hits, misses and hit rate"""
+        return {
+            "entries": len(self.index),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate(), 4)
+        }
+
+
+class CachedEmbeddingModel:
+    """Wraps an embedding model so that every `encode` call consults the EmbeddingCache first
+    and only runs the model on the texts it hasn't seen before (in a single batch).
+
+    Args:
+        model (embedding model): A backend from embedding_backends.get_embedding_model()
+        cache (EmbeddingCache, optional): Defaults to a cache under EMBEDDING_CACHE_DIR for this model and backend.
+    """
+
+    def __init__(self, model, cache=None):
+        self.model = model
+        self.model_name = model.model_name
+        self.backend_name = model.backend_name
+        # Quantized backends produce slightly different vectors, so they get their own cache
+        self.cache = cache if cache is not None else EmbeddingCache(model_key(model))
+
+    def encode(self, sentences, batch_size=32, convert_to_tensor=False, **kwargs):
+        """Same interface as the wrapped model's encode, served from the cache where possible"""
+        single_input = isinstance(sentences, str)
+        if single_input:
+            sentences = [sentences]
+
+        embeddings = [self.cache.get(sentence) for sentence in sentences]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            missing_texts = [sentences[i] for i in missing]
+            with span('embedding.model_encode'):
+                encoded = np.asarray(self.model.encode(missing_texts, batch_size=batch_size, **kwargs), dtype=np.float32)
+            count('embedding.texts_encoded', len(missing_texts))
+            self.cache.put_many(missing_texts, encoded)
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding
+
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(sentences), -1)
+        return embeddings[0] if single_input else embeddings
+
+
+def get_cached_embedding_model(backend=None):
+    """Embedding model for the configured backend, wrapped with the on-disk cache.
+    Set EMBEDDING_CACHE=0 to bypass the cache.
+
+    Args:
+        backend (str, optional): See embedding_backends.get_embedding_model. Defaults to None.
+
+    Returns:
+        embedding model: CachedEmbeddingModel, or the bare model when the cache is disabled
+    """
+    from embedding_backends import get_embedding_model
+    model = get_embedding_model(backend)
+    if os.getenv('EMBEDDING_CACHE', '1') == '0':
+        return model
+    return CachedEmbeddingModel(model)
+
+
+def print_cache_stats(model):
+    """Prints the hit rate of the embedding cache, if the model has one"""
+    if isinstance(model, CachedEmbeddingModel):
+        print("Embedding cache: ", model.cache.stats())
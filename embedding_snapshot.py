@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import numpy as np
+from instrumentation import count, timed
+
+# Snapshot of the ChromaDB embeddings as contiguous float32 .npy files, so matching can score against
+# memory-mapped arrays instead of pulling nested Python lists out of ChromaDB for every patient.
+# Each collection gets `{name}.json` (row ids and the .npy file they belong to) and `{name}-{version}.npy`.
+# Rows are stored L2 normalized, so cosine similarity is a plain dot product.
+# Staleness is checked cheaply, from the collection's IDs and the embedding model recorded in the index (another
+# EMBEDDING_BACKEND re-fetches everything). Documents are never read: code that re-upserts rows under an existing
+# ID passes them as changed_ids (trial_archive.py reparse, the patient paths of find_matching_trial.py).
+# A refresh writes a new .npy version and then swaps the index, so processes that already mapped the old
+# version keep reading it (the OS keeps the file alive) and several workers share one page-cached copy.
+
+EMBEDDING_SNAPSHOT_DIR = './embedding_snapshot'
+FETCH_BATCH_SIZE = 1000
+
+
+class EmbeddingSnapshot:
+    """Memory-mapped embeddings of one collection
+
+    Args:
+        ids (list): ID of every row
+        vectors (np.ndarray): (len(ids), dim) read-only memory-mapped array of normalized embeddings
+        model (str, optional): embedding_cache.model_key of the model the vectors came from. Defaults to None.
+    """
+
+    def __init__(self, ids, vectors, model=None):
+        self.ids = ids
+        self.vectors = vectors
+        self.model = model
+        self.id_to_row = {id: row for row, id in enumerate(ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, id):
+        """Returns the embedding for the given ID, or None if it isn't in the snapshot"""
+        row = self.id_to_row.get(id)
+        return None if row is None else self.vectors[row]
+
+
+def _index_path(name, snapshot_dir):
+    return os.path.join(snapshot_dir, f'{name}.json')
+
+
+def load_snapshot(name, snapshot_dir=EMBEDDING_SNAPSHOT_DIR):
+    """Loads the snapshot of a collection without copying it into memory
+
+    Args:
+        name (str): Collection name
+        snapshot_dir (str, optional): Defaults to EMBEDDING_SNAPSHOT_DIR.
+
+    Returns:
+        EmbeddingSnapshot: the snapshot, or None if the collection was never exported
+    """
+    index_path = _index_path(name, snapshot_dir)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as index_file:
+        index = json.load(index_file)
+    vectors = np.load(os.path.join(snapshot_dir, index['file']), mmap_mode='r')
+    return EmbeddingSnapshot(index['ids'], vectors, index.get('model'))
+
+
+def _fetch_embeddings(collection, ids):
+    """Fetches embeddings from ChromaDB in batches, returned as a normalized float32 array in the order of ids"""
+    fetched = {}
+    for start in range(0, len(ids), FETCH_BATCH_SIZE):
+        result = collection.get(ids=ids[start:start + FETCH_BATCH_SIZE], include=['embeddings'])
+        for id, embedding in zip(result['ids'], result['embeddings']):
+            fetched[id] = embedding
+    vectors = np.asarray([fetched[id] for id in ids], dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.clip(norms, 1e-12, None)
+
+
+def refresh_snapshot(collection, changed_ids=None, snapshot_dir=EMBEDDING_SNAPSHOT_DIR, model_key=None):
+    """Brings the snapshot of a collection up to date. Only embeddings of IDs that are new or listed in
+    changed_ids are fetched from ChromaDB, the rest are copied over from the previous snapshot. Everything is
+    fetched again when the snapshot was written for another embedding model. Only the collection's IDs are read
+    to find out, so calling it when nothing changed is cheap.
+
+    Args:
+        collection (chromadb.collection): The collection to export
+        changed_ids (list, optional): IDs that already exist in the snapshot but were re-upserted (new text or
+            embedding). Defaults to None.
+        snapshot_dir (str, optional): Defaults to EMBEDDING_SNAPSHOT_DIR.
+        model_key (str, optional): embedding_cache.model_key of the model in use. Defaults to None (not checked).
+
+    Returns:
+        EmbeddingSnapshot: the refreshed snapshot, or None if the collection is empty
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    name = collection.name
+    previous = load_snapshot(name, snapshot_dir)
+    previous_ids = {}
+    # Snapshots written by another model are fetched again in full
+    if previous is not None and model_key in (None, previous.model):
+        previous_ids = previous.id_to_row
+    changed_ids = set(changed_ids or [])
+    model_key = model_key or (previous.model if previous is not None else None)
+
+    collection_ids = collection.get(include=[])['ids']
+    to_fetch = [id for id in collection_ids if id not in previous_ids or id in changed_ids]
+    if previous is not None and not to_fetch and collection_ids == previous.ids and model_key == previous.model:
+        return previous
+    if not collection_ids:
+        return None
+
+    fetched = _fetch_embeddings(collection, to_fetch) if to_fetch else None
+    dim = fetched.shape[1] if fetched is not None else previous.vectors.shape[1]
+
+    version = f'{int(time.time() * 1000)}-{os.getpid()}'
+    file_name = f'{name}-{version}.npy'
+    vectors = np.lib.format.open_memmap(os.path.join(snapshot_dir, file_name), mode='w+',
+                                        dtype=np.float32, shape=(len(collection_ids), dim))
+    to_fetch_set = set(to_fetch)
+    kept = [(row, previous_ids[id]) for row, id in enumerate(collection_ids) if id not in to_fetch_set]
+    if kept:
+        new_rows, old_rows = map(np.asarray, zip(*kept))
+        vectors[new_rows] = previous.vectors[old_rows]
+    if fetched is not None:
+        collection_rows = {id: row for row, id in enumerate(collection_ids)}
+        vectors[np.asarray([collection_rows[id] for id in to_fetch])] = fetched
+    vectors.flush()
+    del vectors
+
+    # Swap the index over to the new version, then drop the old file
+    index_path = _index_path(name, snapshot_dir)
+    with open(index_path + '.tmp', 'w') as index_file:
+        json.dump({"file": file_name, "ids": collection_ids, "model": model_key}, index_file)
+    os.replace(index_path + '.tmp', index_path)
+    if previous is not None:
+        old_file = previous.vectors.filename
+        del previous
+        try:
+            os.remove(old_file)
+        except OSError:  # Still mapped by another process on Windows, left for the next refresh
+            pass
+
+    print(f"Embedding snapshot of '{name}': {len(collection_ids)} rows, {len(to_fetch)} fetched from ChromaDB")
+    return load_snapshot(name, snapshot_dir)
+
+
+class TrialEmbeddingSnapshot:
+    """Inclusion and exclusion snapshots aligned by trial ID, for scoring a patient against every trial at once
+
+    Args:
+        inclusion (EmbeddingSnapshot): Snapshot of the inclusion_criteria collection
+        exclusion (EmbeddingSnapshot): Snapshot of the exclusion_criteria collection
+    """
+
+    def __init__(self, inclusion, exclusion):
+        self.inclusion = inclusion
+        self.exclusion = exclusion
+        # Row of each inclusion trial in the exclusion array, -1 when a trial has no exclusion criteria
+        self.exclusion_rows = np.asarray([exclusion.id_to_row.get(id, -1) for id in inclusion.ids], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.inclusion)
+
+    @timed('snapshot.score_trials')
+    def score_trials(self, patient_embedding, top_k=100, score_threshold=0.1):
+        """Same scoring as find_matching_trials_per_patient: take the top_k trials by inclusion similarity,
+        score them as similarity(inclusion) - similarity(exclusion) and keep the ones above the threshold.
+
+        Args:
+            patient_embedding (list or np.ndarray): Embedding of the patient summary
+            top_k (int, optional): Number of closest trials by inclusion criteria. Defaults to 100.
+            score_threshold (float, optional): Minimum score to keep a trial. Defaults to 0.1.
+
+        Returns:
+            list: (trial_id, score) tuples sorted by score, highest first
+        """
+        patient_embedding = np.asarray(patient_embedding, dtype=np.float32)
+        patient_embedding = patient_embedding / max(float(np.linalg.norm(patient_embedding)), 1e-12)
+
+        inclusion_similarity = self.inclusion.vectors @ patient_embedding
+        top_k = min(top_k, len(inclusion_similarity))
+        top_rows = np.argpartition(-inclusion_similarity, top_k - 1)[:top_k]
+
+        exclusion_rows = self.exclusion_rows[top_rows]
+        exclusion_similarity = np.zeros(top_k, dtype=np.float32)
+        has_exclusion = exclusion_rows >= 0
+        exclusion_similarity[has_exclusion] = self.exclusion.vectors[exclusion_rows[has_exclusion]] @ patient_embedding
+
+        scores = inclusion_similarity[top_rows] - exclusion_similarity
+        count('vectors.scored', len(inclusion_similarity) + int(has_exclusion.sum()))
+        trial_scores = [(self.inclusion.ids[row], float(score))
+                        for row, score in zip(top_rows, scores) if score > score_threshold]
+        trial_scores.sort(key=lambda x: x[1], reverse=True)
+        return trial_scores
+
+
+def load_trial_snapshot(inclusion_collection, exclusion_collection, snapshot_dir=EMBEDDING_SNAPSHOT_DIR,
+                        model_key=None):
+    """Loads the trial snapshot, refreshed first with the trials that were added, or all of them when they were
+    embedded with another model since it was written. Trials re-upserted under their ID are refreshed by the
+    code that upserts them (see refresh_snapshot).
+
+    Args:
+        inclusion_collection (chromadb.collection): inclusion_criteria collection
+        exclusion_collection (chromadb.collection): exclusion_criteria collection
+        snapshot_dir (str, optional): Defaults to EMBEDDING_SNAPSHOT_DIR.
+        model_key (str, optional): embedding_cache.model_key of the model in use. Defaults to None.
+
+    Returns:
+        TrialEmbeddingSnapshot: the snapshot, or None if there are no trials yet
+    """
+    snapshots = [refresh_snapshot(collection, snapshot_dir=snapshot_dir, model_key=model_key)
+                 for collection in (inclusion_collection, exclusion_collection)]
+    if snapshots[0] is None or snapshots[1] is None:
+        return None
+    return TrialEmbeddingSnapshot(*snapshots)
+
+
+def main():
+    """Refreshes the snapshots of all the collections in the local ChromaDB"""
+    from chromadb import PersistentClient
+    client = PersistentClient("./chromadb_clinicaltrial")
+    for collection_name in ("inclusion_criteria", "exclusion_criteria", "patient_data"):
+        refresh_snapshot(client.get_or_create_collection(collection_name))
+
+
+if __name__ == "__main__":
+    main()
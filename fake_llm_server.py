@@ -0,0 +1,144 @@
+import re
+import json
+import time
+import asyncio
+import hashlib
+from aiohttp import web
+from benchmark_data import CONDITIONS
+
+# Deterministic stand-in for the LLM APIs and clinicaltrials.gov, used by the offline benchmark.
+# - POST /v1/chat/completions (and /api/v1/chat/completions) answers in the OpenAI chat completions format
+#   the summarize_apis clients read. The answer only depends on the prompt, after a configurable delay.
+#   Eligibility prompts (medical_llm_filter) get a score on the first line followed by reasons, as
+#   find_matching_trial expects. Any other prompt is a patient summary and gets a {"p_id", "summary"} JSON
+#   built from the conditions found in the prompt.
+# - GET /api/v2/studies and /api/v2/studies/{nct_id} serve a trial corpus from benchmark_data.py with
+#   pageToken pagination, like the clinicaltrials.gov API v2 (see trial_api_client.py).
+# Point the pipeline at it with HUGGINGFACE_BASE_URL=http://127.0.0.1:8089 (or OPENROUTER_URL / OLLAMA_URL)
+# and web_scraper_trials.py --fetch-mode http --api-url http://127.0.0.1:8089/api/v2
+# Example: python fake_llm_server.py --port 8089 --latency-ms 200 --jitter-ms 50 --trials trials.json
+
+CONDITION_NAMES = [description.split(' (')[0] for _, description, _ in CONDITIONS]
+
+
+def _digest(text):
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+
+def _count_tokens(text):
+    return len(text.split())
+
+
+def fake_completion(prompt):
+    """Deterministic answer to a prompt
+
+    Args:
+        prompt (str): Content of the user message
+
+    Returns:
+        str: the answer
+    """
+    digest = _digest(prompt)
+    if '# Inclusion Criterion' not in prompt:
+        # Patient summary, mention the known conditions that appear in the patient data
+        patient_id = re.search(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}', prompt)
+        conditions = [name for name in CONDITION_NAMES if name.lower() in prompt.lower()] or ['no chronic conditions']
+        summary = (f"Adult patient with a history of {', '.join(conditions)}. "
+                   f"Currently followed up for {conditions[0]}, with regular vital sign observations.")
+        return json.dumps({"p_id": patient_id.group(0) if patient_id else "", "summary": summary})
+
+    score = round(int.from_bytes(digest[:2], 'big') / 65535, 2)
+    verdict = "meets the inclusion criteria" if score >= 0.5 else "does not clearly meet the inclusion criteria"
+    return (f"{score}\n"
+            f"The patient {verdict} based on the documented diagnoses.\n"
+            f"No exclusion criterion is explicitly met in the clinical note.\n"
+            f"Some laboratory values needed for the assessment are not reported.")
+
+
+async def chat_completions(request):
+    config = request.app['config']
+    body = await request.json()
+    prompt = '\n'.join(str(message.get('content', '')) for message in body.get('messages', []))
+    content = fake_completion(prompt)
+
+    # Latency in [latency - jitter, latency + jitter], picked from the prompt so runs are reproducible
+    jitter = (int.from_bytes(_digest(prompt)[2:4], 'big') / 65535 * 2 - 1) * config['jitter_ms']
+    await asyncio.sleep(max(0.0, config['latency_ms'] + jitter) / 1000)
+
+    prompt_tokens, completion_tokens = _count_tokens(prompt), _count_tokens(content)
+    return web.json_response({
+        "id": f"chatcmpl-{_digest(prompt).hex()[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get('model') or 'fake-llm',
+        "system_fingerprint": "fake-llm",
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+            "logprobs": None
+        }],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens}
+    })
+
+
+async def list_studies(request):
+    studies = request.app['studies']
+    page_size = int(request.query.get('pageSize', 10))
+    start = int(request.query.get('pageToken', 0))
+    page = {"studies": studies[start:start + page_size]}
+    if start + page_size < len(studies):
+        page["nextPageToken"] = str(start + page_size)
+    return web.json_response(page)
+
+
+async def get_study(request):
+    study = request.app['studies_by_id'].get(request.match_info['nct_id'])
+    if study is None:
+        raise web.HTTPNotFound()
+    return web.json_response(study)
+
+
+async def health(request):
+    return web.json_response({"status": "ok", "trials": len(request.app['studies'])})
+
+
+def create_app(latency_ms=0, jitter_ms=0, trials_path=None):
+    """aiohttp application of the fake server
+
+    Args:
+        latency_ms (float, optional): Mean delay of a chat completion. Defaults to 0.
+        jitter_ms (float, optional): Maximum deviation from latency_ms. Defaults to 0.
+        trials_path (str, optional): JSON list of studies to serve, see benchmark_data.py. Defaults to None.
+    """
+    app = web.Application()
+    app['config'] = {"latency_ms": latency_ms, "jitter_ms": jitter_ms}
+    studies = []
+    if trials_path:
+        with open(trials_path) as trials_file:
+            studies = json.load(trials_file)
+    app['studies'] = studies
+    app['studies_by_id'] = {study['protocolSection']['identificationModule']['nctId']: study for study in studies}
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    app.router.add_post('/api/v1/chat/completions', chat_completions)
+    app.router.add_get('/api/v2/studies', list_studies)
+    app.router.add_get('/api/v2/studies/{nct_id}', get_study)
+    app.router.add_get('/health', health)
+    return app
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Deterministic fake LLM and clinical trials API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--trials', default=None, help="JSON list of studies generated by benchmark_data.py")
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency_ms, args.jitter_ms, args.trials), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,31 @@
-import json
 from summarize_apis.huggingface import summarize
 from combine_patient_data import create_patient_profile, get_all_patient_ids
-from sentence_transformers import SentenceTransformer
+from embedding_cache import get_cached_embedding_model, print_cache_stats, model_key
 from chromadb import PersistentClient
 from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
 from create_clinical_trial_embeddings import check_id_exists, get_or_create_collection, embed_and_add_single_entry
+from embedding_snapshot import load_trial_snapshot, refresh_snapshot
+from results_store import (new_run_id, save_match_results, save_pending_results, replace_patient_results,
+                           export_patient_json, get_pending_results, STATUS_ADJUDICATED, STATUS_UNPARSEABLE)
+from instrumentation import span, count, timed, export_run
 
 # Create instance of embedding model
-model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+model = get_cached_embedding_model()
 # Create instance of ChromaDB client
 client = PersistentClient("./chromadb_clinicaltrial")
 # Get the collection object for our clinical trials collection
 inclusion_collection = client.get_collection("inclusion_criteria")
 exclusion_collection = client.get_collection("exclusion_criteria")
 patient_collection = client.get_or_create_collection("patient_data")
+# Memory-mapped copy of the trial embeddings, scored with numpy instead of per-trial ChromaDB round-trips.
+# Falls back to ChromaDB when there is no snapshot yet.
+trial_snapshot = load_trial_snapshot(inclusion_collection, exclusion_collection, model_key=model_key(model))
+# Same for the embedded patients, only patients embedded during this run are read from ChromaDB
+patient_snapshot = refresh_snapshot(patient_collection, model_key=model_key(model))
+# LLM used for the eligibility verdicts and the ID of this run, both stored with every match result
+LLM_MODEL = 'meta-llama/Llama-3.2-3B-Instruct'
+RUN_ID = new_run_id()
 
 def calculate_similarity(embedding1, embedding2):
     # embedding1 = np.atleast_2d(embedding1)
@@ -25,7 +36,8 @@ def calculate_similarity(embedding1, embedding2):
     #     embedding2 = embedding2.reshape(1, -1)
     return cosine_similarity([embedding1], [embedding2])[0][0]
 
-def find_matching_trials_per_patient(patient_id, top_k=100, score_threshold=0.1):
+@timed('match.patient')
+def find_matching_trials_per_patient(patient_id, top_k=100, score_threshold=0.1, adjudicate=True):
     """This function helps us find the matching clinical trials for a given patient.
     It takes in a patient ID, and top_k (default 100), to get 100 matching trials to given patient 
     based on vector search similarities.
@@ -33,6 +45,8 @@ def find_matching_trials_per_patient(patient_id, top_k=100, score_threshold=0.1)
     Args:
         patient_id (str): Patient ID
         top_k (int, optional): Get Top k matching elements. Defaults to 100.
+        adjudicate (bool, optional): Ask the LLM about the candidates right away, otherwise they are stored as
+            pending pairs for adjudicate_pending_results. Defaults to True.
 
     Returns:
         list: IDs of all the clinical trials
@@ -57,26 +71,86 @@ def find_matching_trials_per_patient(patient_id, top_k=100, score_threshold=0.1)
         embed_and_add_single_entry(patient_collection, model, summarized_patient_profile, patient_id)
     
     
-    summarized_patient_profile = patient_collection.get(ids=patient_id, include=['embeddings', 'documents'])
-    embedding_summarized_patient_profile = summarized_patient_profile['embeddings'][0]
-    text_summarized_patient_profile = summarized_patient_profile['documents'][0]
+    with span('match.retrieve'):
+        embedding_summarized_patient_profile = patient_snapshot.get(patient_id) if patient_snapshot is not None else None
+        include = ['documents'] if embedding_summarized_patient_profile is not None else ['embeddings', 'documents']
+        with span('chromadb.get'):
+            summarized_patient_profile = patient_collection.get(ids=patient_id, include=include)
+        if embedding_summarized_patient_profile is None:
+            embedding_summarized_patient_profile = summarized_patient_profile['embeddings'][0]
+        text_summarized_patient_profile = summarized_patient_profile['documents'][0]
+        # Find closest matching trials to this patient vector from the trial vectors
+        if trial_snapshot is not None:
+            trial_scores = trial_snapshot.score_trials(embedding_summarized_patient_profile, top_k, score_threshold)
+        else:
+            trial_scores = score_trials_from_chromadb(embedding_summarized_patient_profile, top_k, score_threshold)
+
+    if len(trial_scores) > 15:
+        n_candidates = 15
+    elif len(trial_scores) < 10:
+        n_candidates = len(trial_scores)  # Take all available scores if less than 10
+    else:
+        n_candidates = 10  # Default to 10 if between 10 and 15
+    trial_scores = trial_scores[:n_candidates] # Taking only top n candidates from the top matching scores.
+    # print(trial_scores)
+    print("##############")
+    print(f"Found: {len(trial_scores)} potentially compatible trials for patient: {patient_id}")
+    if not adjudicate:
+        # Keeps the verdicts already stored for these pairs, the new ones wait for adjudicate_pending_results
+        trial_metadata = inclusion_collection.get(ids=[trial_ID for trial_ID, _ in trial_scores], include=['metadatas'])
+        trial_names = {trial_ID: (metadata or {}).get('study_title')
+                       for trial_ID, metadata in zip(trial_metadata['ids'], trial_metadata['metadatas'])}
+        save_pending_results([{"patient_id": patient_id, "trial_id": trial_ID, "trial_name": trial_names.get(trial_ID),
+                               "retrieval_score": retrieval_score, "run_id": RUN_ID}
+                              for trial_ID, retrieval_score in trial_scores])
+        return
+    print("Asking an expert LLM with these subsets to fetch the most relevant trials")
+    print("###############")
+    match_results = []
+    for trial_ID, retrieval_score in trial_scores:
+        matched_trial = medical_llm_filter(patient_id,
+                            text_summarized_patient_profile, 
+                           trial_ID)
+        matched_trial["retrieval_score"] = retrieval_score
+        match_results.append(matched_trial)
+    # Store every assessed pair (eligible or not) in one bulk insert, dropping trials earlier runs selected
+    # but this one didn't, then write the legacy JSON file from the store
+    replace_patient_results(patient_id, match_results)
+    print(f"JSON data saved to {export_patient_json(patient_id)}")
+    print("\n\n################################")
+    # 
+
+def score_trials_from_chromadb(embedding_summarized_patient_profile, top_k=100, score_threshold=0.1):
+    """Scores the top_k closest trials (by inclusion criteria) for a patient embedding, fetching the
+    trial embeddings from ChromaDB. Used when there is no embedding snapshot.
+
+    Args:
+        embedding_summarized_patient_profile (list): Embedding of the patient summary
+        top_k (int, optional): Get Top k matching elements. Defaults to 100.
+        score_threshold (float, optional): Minimum score to keep a trial. Defaults to 0.1.
+
+    Returns:
+        list: (trial_id, score) tuples sorted by score, highest first
+    """
     # Find closest matching trials to this patient vector from the trial vectors in the chromaDB
-    inclusion_topk_matches = inclusion_collection.query(
-        query_embeddings=embedding_summarized_patient_profile,
-        include=['embeddings','metadatas'],
-        n_results=top_k
-    )
+    with span('chromadb.query'):
+        inclusion_topk_matches = inclusion_collection.query(
+            query_embeddings=np.asarray(embedding_summarized_patient_profile, dtype=np.float32).tolist(),
+            include=['embeddings','metadatas'],
+            n_results=top_k
+        )
     # print(inclusion_topk_matches)
     
     trial_scores = []
-    for i in range(top_k):
+    for i in range(len(inclusion_topk_matches['ids'][0])):
         trial_id = inclusion_topk_matches['ids'][0][i]
         inclusion_embedding = inclusion_topk_matches["embeddings"][0][i]
 
-        exclusion_results = exclusion_collection.get(
-            ids=trial_id,
-            include=["embeddings"]
-        )
+        with span('chromadb.get'):
+            exclusion_results = exclusion_collection.get(
+                ids=trial_id,
+                include=["embeddings"]
+            )
         exclusion_embedding = exclusion_results['embeddings'][0]
         # print(len(embedding_summarized_patient_profile))
         # print(inclusion_embedding.shape)
@@ -84,39 +158,19 @@ def find_matching_trials_per_patient(patient_id, top_k=100, score_threshold=0.1)
         similarity_inclusion = calculate_similarity(embedding_summarized_patient_profile, inclusion_embedding)
         similarity_exclusion = calculate_similarity(embedding_summarized_patient_profile, exclusion_embedding)
         
+        count('vectors.scored', 2)
         score = 1 * similarity_inclusion - 1 * similarity_exclusion
         if score > score_threshold:
             trial_scores.append((trial_id, score))
 
     trial_scores.sort(key=lambda x: x[1], reverse=True)
-    if len(trial_scores) > 15:
-        n_candidates = 15
-    elif len(trial_scores) < 10:
-        n_candidates = len(trial_scores)  # Take all available scores if less than 10
-    else:
-        n_candidates = 10  # Default to 10 if between 10 and 15
-    trial_scores = trial_scores[:n_candidates] # Taking only top n candidates from the top matching scores.
-    # print(trial_scores)
-    print("##############")
-    print(f"Found: {len(trial_scores)} potentially compatible trials for patient: {patient_id}")
-    print("Asking an expert LLM with these subsets to fetch the most relevant trials")
-    print("###############")
-    eligible_trials_json = {
-        "patientId": patient_id,
-        "eligibleTrials": []
-    }
-    for trial_ID, _ in trial_scores:
-        matched_trial = medical_llm_filter(patient_id,
-                            text_summarized_patient_profile, 
-                           trial_ID)
-        eligible_trials_json["eligibleTrials"].append(matched_trial)
-    save_json_to_file(eligible_trials_json, f'patient_trials_matched/patient_{patient_id}.json')
-    print("\n\n################################")
-    # 
+    return trial_scores
 
+@timed('match.adjudicate')
 def medical_llm_filter(patient_id, patient_data, clinical_trial_id):
-    inclusion_criterion = inclusion_collection.get(ids=clinical_trial_id)["documents"][0]
-    exclusion_criterion_all = exclusion_collection.get(ids=clinical_trial_id)
+    with span('chromadb.get'):
+        inclusion_criterion = inclusion_collection.get(ids=clinical_trial_id)["documents"][0]
+        exclusion_criterion_all = exclusion_collection.get(ids=clinical_trial_id)
     exclusion_criterion = exclusion_criterion_all["documents"][0]
     trial_name = exclusion_criterion_all["metadatas"][0]["study_title"]
     # print("INC CRI", inclusion_criterion)
@@ -146,38 +200,30 @@ def medical_llm_filter(patient_id, patient_data, clinical_trial_id):
     """
 
 
-    medical_llm_verdict = summarize(medical_prompt_template, agent_prompt=False,max_tokens=500)
+    medical_llm_verdict = summarize(medical_prompt_template, agent_prompt=False, model=LLM_MODEL, max_tokens=500)
     print("- Medical Reasoning for Trial ID: ", clinical_trial_id)
     print(medical_llm_verdict)
     score = extract_score(medical_llm_verdict)
-    if score >= 0.5:
-        eligibility_reasons = medical_llm_verdict.splitlines()[1:]  # Skip the first line (the score)
-        eligibility_criteria_met = []
-
-        # You may need to further process eligibility_reasons to extract specific criteria
-        for reason in eligibility_reasons:
-            if reason.strip():  # Ensure it's not an empty line
-                eligibility_criteria_met.append(reason.strip())
-
-        # Add the trial details to the eligible trials
-        trial_entry = {
-            "trialId": clinical_trial_id,
-            "trialName": trial_name,
-            "eligibilityCriteriaMet": eligibility_criteria_met
-        }
-        return trial_entry
-
-def save_json_to_file(json_data, filename):
-    """
-    Saves the JSON data to a file.
+    eligibility_reasons = medical_llm_verdict.splitlines()[1:]  # Skip the first line (the score)
+    eligibility_criteria_met = []
 
-    Parameters:
-    - json_data (dict): The JSON data to save.
-    - filename (str): The name of the file to save the JSON data.
-    """
-    with open(filename, 'w') as json_file:
-        json.dump(json_data, json_file, indent=2)
-        print(f"JSON data saved to {filename}")
+    # You may need to further process eligibility_reasons to extract specific criteria
+    for reason in eligibility_reasons:
+        if reason.strip():  # Ensure it's not an empty line
+            eligibility_criteria_met.append(reason.strip())
+
+    # Row for the results store, eligibility (score >= 0.5) is derived when it's saved.
+    # A verdict without a parseable score is still an answer, it must not go back to the pending queue
+    return {
+        "patient_id": patient_id,
+        "trial_id": clinical_trial_id,
+        "trial_name": trial_name,
+        "llm_score": score,
+        "reasons": eligibility_criteria_met,
+        "model": LLM_MODEL,
+        "run_id": RUN_ID,
+        "status": STATUS_ADJUDICATED if score is not None else STATUS_UNPARSEABLE
+    }
 
 
 def extract_score(output):
@@ -200,19 +246,67 @@ def extract_score(output):
         # Return None if the score can't be extracted
         return None
 
-def find_matching_trials_for_all():
+def find_matching_trials_for_all(api_limit=15, adjudicate=True):
     """
     Just a function to run the summarize and find matching trials on all patient IDs.
-    Limited to 10 due to API Rate limits. 
+    Limited to 15 due to API Rate limits. 
+
+    Args:
+        api_limit (int, optional): Number of patients to match. Defaults to 15.
+        adjudicate (bool, optional): See find_matching_trials_per_patient. Defaults to True.
     """
     patient_ids = get_all_patient_ids()
-    API_LIMIT = 15
-    for i in range(0, API_LIMIT): # Limiting due to API restrictions
-        matching_trials = find_matching_trials_per_patient(patient_ids[i][0])
+    for i in range(0, min(api_limit, len(patient_ids))): # Limiting due to API restrictions
+        matching_trials = find_matching_trials_per_patient(patient_ids[i][0], adjudicate=adjudicate)
+    print_cache_stats(model)
+    # Export the newly embedded patients to the memory-mapped snapshot
+    refresh_snapshot(patient_collection, model_key=model_key(model))
         
+def adjudicate_pending_results(limit=50):
+    """Runs the LLM verdict on (patient, trial) pairs that only have a retrieval score so far,
+    i.e. the pairs reverse_matching added when new trials were scraped. Best retrieval scores go first.
+
+    Args:
+        limit (int, optional): Maximum number of pairs to send to the LLM, due to API rate limits. Defaults to 50.
+    """
+    pending_results = get_pending_results(limit)
+    if not pending_results:
+        return
+    print(f"Asking the expert LLM about {len(pending_results)} pending (patient, trial) pairs")
+    patient_ids = list({result['patient_id'] for result in pending_results})
+    patient_summaries = patient_collection.get(ids=patient_ids, include=['documents'])
+    patient_summaries = dict(zip(patient_summaries['ids'], patient_summaries['documents']))
+
+    match_results = []
+    for pending_result in pending_results:
+        patient_id = pending_result['patient_id']
+        if patient_id not in patient_summaries:
+            continue
+        try:
+            matched_trial = medical_llm_filter(patient_id, patient_summaries[patient_id], pending_result['trial_id'])
+        except Exception as e:
+            print("API Limit error: ", e, " for patient ID", patient_id)
+            break
+        matched_trial["retrieval_score"] = pending_result['retrieval_score']
+        match_results.append(matched_trial)
+
+    save_match_results(match_results)
+    for patient_id in {result['patient_id'] for result in match_results}:
+        export_patient_json(patient_id)
 
 def main():
-    find_matching_trials_for_all()
+    import argparse
+    parser = argparse.ArgumentParser(description="Match patients to clinical trials")
+    parser.add_argument('--patients', type=int, default=15, help="Number of patients to match (API rate limits)")
+    parser.add_argument('--adjudicate', type=int, default=50, help="Maximum pending pairs sent to the LLM")
+    parser.add_argument('--retrieve-only', action='store_true',
+                        help="Store the retrieved trials as pending pairs instead of asking the LLM right away")
+    args = parser.parse_args()
+    find_matching_trials_for_all(args.patients, adjudicate=not args.retrieve_only)
+    # Pairs found by reverse matching when new trials were scraped
+    adjudicate_pending_results(args.adjudicate)
+    # Per-run timings and counters, only written when PIPELINE_METRICS=1
+    export_run('find_matching_trial')
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
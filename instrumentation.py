@@ -0,0 +1,223 @@
+import os
+import json
+import math
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+# Lightweight pipeline instrumentation: timing spans and counters around the hot paths (SQLite queries,
+# encoding, ChromaDB calls, LLM calls, vectors scored, cache hits).
+# Disabled by default. `span` and `count` return straight away when disabled, so they can stay in the hot paths.
+# Enable with PIPELINE_METRICS=1 (or enable()), export_run() then writes a JSON summary per run to
+# PIPELINE_METRICS_DIR, plus a Chrome trace (chrome://tracing, Perfetto) and an OpenMetrics text file
+# when PIPELINE_TRACE=1.
+
+METRICS_DIR = os.getenv('PIPELINE_METRICS_DIR', './metrics')
+MAX_TRACE_EVENTS = 1_000_000
+
+_enabled = os.getenv('PIPELINE_METRICS', '0') == '1'
+_lock = threading.Lock()
+_start_time = time.perf_counter()
+_counters = defaultdict(float)
+_span_stats = {}
+_trace_events = []
+
+
+def enable():
+    """Turns instrumentation on for the rest of the process"""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Clears all recorded spans and counters"""
+    global _start_time
+    with _lock:
+        _start_time = time.perf_counter()
+        _counters.clear()
+        _span_stats.clear()
+        _trace_events.clear()
+
+
+def count(name, value=1):
+    """Adds value to the counter called name"""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] += value
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+@contextmanager
+def _recording_span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        duration = end - start
+        with _lock:
+            stats = _span_stats.get(name)
+            if stats is None:
+                stats = _span_stats[name] = {"count": 0, "total_s": 0.0, "max_s": 0.0}
+            stats["count"] += 1
+            stats["total_s"] += duration
+            stats["max_s"] = max(stats["max_s"], duration)
+            if len(_trace_events) < MAX_TRACE_EVENTS:
+                _trace_events.append((name, start, duration, threading.get_ident()))
+
+
+def span(name):
+    """Context manager timing the enclosed block under the given name
+
+    Example:
+        with span("chromadb.query"):
+            collection.query(...)
+    """
+    if not _enabled:
+        return _NOOP_SPAN
+    return _recording_span(name)
+
+
+def timed(name):
+    """Decorator version of span"""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _recording_span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary():
+    """Per span count/total/mean/max time and all counters recorded so far
+
+    Returns:
+        dict: {"wall_time_s", "spans": {name: {...}}, "counters": {name: value}}
+    """
+    with _lock:
+        spans = {
+            name: {
+                "count": stats["count"],
+                "total_ms": round(stats["total_s"] * 1000, 3),
+                "mean_ms": round(stats["total_s"] * 1000 / stats["count"], 3),
+                "max_ms": round(stats["max_s"] * 1000, 3)
+            }
+            for name, stats in sorted(_span_stats.items())
+        }
+        counters = {name: (int(value) if float(value).is_integer() else value)
+                    for name, value in sorted(_counters.items())}
+    return {"wall_time_s": round(time.perf_counter() - _start_time, 3), "spans": spans, "counters": counters}
+
+
+def percentile(values, q):
+    """q-th percentile (0-100) of the given values, nearest-rank method"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def latency_summary(latencies):
+    """Count, p50, p90, p99 and max of a list of latencies in seconds, reported in milliseconds"""
+    latencies = list(latencies)
+    if not latencies:
+        return {"count": 0}
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2)
+    }
+
+
+def write_summary(path):
+    """Writes summary() as JSON"""
+    with open(path, 'w') as summary_file:
+        json.dump(summary(), summary_file, indent=2)
+
+
+def write_chrome_trace(path):
+    """Writes every recorded span as a Chrome trace event file (load it in chrome://tracing or Perfetto)"""
+    with _lock:
+        events = [
+            {"name": name, "ph": "X", "ts": round((start - _start_time) * 1e6, 1),
+             "dur": round(duration * 1e6, 1), "pid": os.getpid(), "tid": thread_id}
+            for name, start, duration, thread_id in _trace_events
+        ]
+    with open(path, 'w') as trace_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+
+def _metric_name(name):
+    return 'pipeline_' + ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def write_openmetrics(path):
+    """Writes the counters and span timings in the OpenMetrics text format"""
+    run_summary = summary()
+    lines = []
+    for name, value in run_summary["counters"].items():
+        metric = _metric_name(name)
+        lines += [f"# TYPE {metric} counter", f"{metric}_total {value}"]
+    for name, stats in run_summary["spans"].items():
+        metric = _metric_name(name) + '_seconds'
+        lines += [f"# TYPE {metric} summary",
+                  f"{metric}_count {stats['count']}",
+                  f"{metric}_sum {stats['total_ms'] / 1000}"]
+    lines.append("# EOF")
+    with open(path, 'w') as metrics_file:
+        metrics_file.write('\n'.join(lines) + '\n')
+
+
+def export_run(run_name, metrics_dir=None, trace=None):
+    """Writes the files of this run if instrumentation is enabled:
+    {run_name}-{timestamp}.json always, .trace.json and .prom as well when trace is on.
+
+    Args:
+        run_name (str): Name of the pipeline step, e.g. 'find_matching_trial'
+        metrics_dir (str, optional): Defaults to PIPELINE_METRICS_DIR or ./metrics.
+        trace (bool, optional): Also write the Chrome trace and OpenMetrics files. Defaults to PIPELINE_TRACE=1.
+
+    Returns:
+        str: path of the JSON summary, or None when instrumentation is disabled
+    """
+    if not _enabled:
+        return None
+    metrics_dir = metrics_dir or METRICS_DIR
+    if trace is None:
+        trace = os.getenv('PIPELINE_TRACE', '0') == '1'
+    os.makedirs(metrics_dir, exist_ok=True)
+    prefix = os.path.join(metrics_dir, f"{run_name}-{time.strftime('%Y%m%dT%H%M%S')}")
+    write_summary(prefix + '.json')
+    if trace:
+        write_chrome_trace(prefix + '.trace.json')
+        write_openmetrics(prefix + '.prom')
+    print(f"Pipeline metrics written to {prefix}.json")
+    return prefix + '.json'
@@ -0,0 +1,89 @@
+import asyncio
+import random
+import time
+import httpx
+from instrumentation import latency_summary
+
+# Load test for matching_service.py. Fires requests at the running service with a fixed number of concurrent
+# clients and reports throughput and client-side p50/p90/p99 latency, followed by the service's own /stats.
+# Example: python load_test_matching_service.py --requests 2000 --concurrency 32 --mode profile
+
+SAMPLE_PROFILES = [
+    "58 year old male with type 2 diabetes mellitus and essential hypertension, taking metformin and lisinopril.",
+    "34 year old female with moderate persistent asthma, uses an albuterol inhaler, no known drug allergies.",
+    "71 year old female with chronic kidney disease stage 3 and atrial fibrillation on apixaban.",
+    "45 year old male with major depressive disorder treated with sertraline, history of obesity.",
+    "62 year old male, former smoker, diagnosed with non-small cell lung cancer, ECOG performance status 1."
+]
+
+
+async def run_load_test(url, n_requests, concurrency, mode, patient_ids):
+    """Sends n_requests to the service from `concurrency` concurrent clients
+
+    Args:
+        url (str): Base URL of the service
+        n_requests (int): Total number of requests
+        concurrency (int): Number of requests in flight at any time
+        mode (str): 'profile' (POST /match/profile) or 'patient' (GET /match/patient/{id})
+        patient_ids (list): Patient IDs to pick from in 'patient' mode
+
+    Returns:
+        dict: throughput, error count and latency summary
+    """
+    latencies = []
+    errors = 0
+    counter = iter(range(n_requests))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                start = time.perf_counter()
+                try:
+                    if mode == 'patient':
+                        response = await client.get(f"/match/patient/{random.choice(patient_ids)}")
+                    else:
+                        # A unique suffix so the embedding cache doesn't turn this into a lookup benchmark
+                        profile = f"{random.choice(SAMPLE_PROFILES)} Visit {i}."
+                        response = await client.post("/match/profile", json={"profile": profile})
+                    response.raise_for_status()
+                    latencies.append(time.perf_counter() - start)
+                except httpx.HTTPError:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+        service_stats = (await client.get("/stats")).json()
+
+    return {
+        "requests_per_sec": round(len(latencies) / elapsed, 2),
+        "errors": errors,
+        "latency": latency_summary(latencies),
+        "service": service_stats
+    }
+
+
+def main():
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description="Load test the clinical trial matching service")
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--mode', choices=('profile', 'patient'), default='profile')
+    parser.add_argument('--patients', type=int, default=15, help="Number of patient IDs to use in 'patient' mode")
+    args = parser.parse_args()
+
+    patient_ids = []
+    if args.mode == 'patient':
+        from combine_patient_data import get_all_patient_ids
+        patient_ids = [row[0] for row in get_all_patient_ids()[:args.patients]]
+
+    result = asyncio.run(run_load_test(args.url, args.requests, args.concurrency, args.mode, patient_ids))
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
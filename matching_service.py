@@ -0,0 +1,306 @@
+import os
+import asyncio
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
+from pydantic import BaseModel
+from embedding_snapshot import EMBEDDING_SNAPSHOT_DIR, TrialEmbeddingSnapshot, load_snapshot, refresh_snapshot
+from embedding_cache import model_key
+from instrumentation import latency_summary
+
+# Long running matching service. Keeps the embedding model, ChromaDB collections, embedding snapshot and
+# cache warm (they are the module level state of find_matching_trial) and answers retrieval requests
+# over HTTP instead of a cold CLI run per match.
+# - Concurrent embedding requests are micro-batched into a single `encode` call (EmbeddingBatcher)
+# - Patients are read from the patient embedding snapshot, concurrent requests for a patient that still has to be
+#   embedded share one summary and embedding
+# - /stats reports p50/p99 latency per endpoint
+# - The trial snapshot is reloaded when a scrape (or reparse) swaps in a new version, no restart needed
+# Run it with `python matching_service.py --port 8000`, load test it with load_test_matching_service.py
+
+LATENCY_WINDOW = 10000  # Number of most recent requests kept per endpoint for the latency percentiles
+SNAPSHOT_RELOAD_SECONDS = 30  # How often the trial snapshot index files are checked for a new version
+
+
+class EmbeddingBatcher:
+    """Collects texts to embed from concurrent requests and encodes them together.
+    A batch is sent to the model when it has max_batch_size texts or max_wait_ms after its first text arrived.
+
+    Args:
+        model (embedding model): Model with a SentenceTransformer-like encode method
+        max_batch_size (int, optional): Defaults to 64.
+        max_wait_ms (float, optional): Defaults to 5.
+    """
+
+    def __init__(self, model, max_batch_size=64, max_wait_ms=5):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self.worker = None
+        self.batches = 0
+        self.texts = 0
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+
+    async def encode(self, text):
+        """Embeds a single text as part of the next batch
+
+        Returns:
+            np.ndarray: the embedding
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                # The model runs in a thread so the event loop keeps accepting requests meanwhile
+                embeddings = await loop.run_in_executor(None, self.model.encode, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.texts += len(texts)
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "mean_batch_size": round(self.texts / self.batches, 2) if self.batches else 0
+        }
+
+
+class ProfileMatchRequest(BaseModel):
+    profile: str
+    top_k: int = 100
+    score_threshold: float = 0.1
+
+
+# Warm state, filled in by lifespan() when the service starts
+state = {}
+latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+
+
+def trial_snapshot_version(snapshot_dir=EMBEDDING_SNAPSHOT_DIR):
+    """Modification times of the trial snapshot indexes, a refresh replaces them when it swaps in a new version"""
+    matcher = state["matcher"]
+    paths = [os.path.join(snapshot_dir, f'{collection.name}.json')
+             for collection in (matcher.inclusion_collection, matcher.exclusion_collection)]
+    return tuple(os.path.getmtime(path) if os.path.exists(path) else None for path in paths)
+
+
+def load_trial_snapshot_files(snapshot_dir=EMBEDDING_SNAPSHOT_DIR):
+    """Maps the current trial snapshot files, without touching ChromaDB"""
+    matcher = state["matcher"]
+    inclusion = load_snapshot(matcher.inclusion_collection.name, snapshot_dir)
+    exclusion = load_snapshot(matcher.exclusion_collection.name, snapshot_dir)
+    if inclusion is None or exclusion is None:
+        return None
+    return TrialEmbeddingSnapshot(inclusion, exclusion)
+
+
+async def reload_trial_snapshot():
+    """Swaps in the new trial snapshot whenever its index files change, e.g. after a scrape"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(SNAPSHOT_RELOAD_SECONDS)
+        version = trial_snapshot_version()
+        if version == state["snapshot_version"]:
+            continue
+        try:
+            trial_snapshot = await loop.run_in_executor(None, load_trial_snapshot_files)
+        except (OSError, ValueError) as e:  # Swapped again while reading, retried on the next check
+            print("Failed to reload the trial snapshot: ", e)
+            continue
+        state["trial_snapshot"] = trial_snapshot
+        state["snapshot_version"] = version
+        print(f"Reloaded the trial snapshot, {len(trial_snapshot or [])} trials")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Importing find_matching_trial loads the model, ChromaDB collections and the trial snapshot once
+    import find_matching_trial as matcher
+    state["matcher"] = matcher
+    state["trial_snapshot"] = matcher.trial_snapshot
+    state["snapshot_version"] = trial_snapshot_version()
+    state["batcher"] = EmbeddingBatcher(matcher.model)
+    state["batcher"].start()
+    state["patient_snapshot"] = matcher.patient_snapshot
+    state["snapshot_lock"] = asyncio.Lock()
+    # Embedding lookups in flight, keyed by patient ID
+    state["in_flight"] = {}
+    reloader = asyncio.create_task(reload_trial_snapshot())
+    print(f"Matching service ready, {len(state['trial_snapshot'] or [])} trials in the embedding snapshot")
+    yield
+    reloader.cancel()
+    await state["batcher"].stop()
+
+
+app = FastAPI(title="Clinical Trial Matching Service", lifespan=lifespan)
+
+
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    latencies[route.path if route is not None else request.url.path].append(time.perf_counter() - start)
+    return response
+
+
+async def score_trials(embedding, top_k, score_threshold):
+    """Scores a patient embedding against all trials, from the snapshot when there is one"""
+    trial_snapshot = state["trial_snapshot"]
+    if trial_snapshot is not None:
+        return trial_snapshot.score_trials(embedding, top_k, score_threshold)
+    # Up to top_k blocking ChromaDB calls, kept off the event loop
+    return await asyncio.get_running_loop().run_in_executor(
+        None, state["matcher"].score_trials_from_chromadb, embedding, top_k, score_threshold)
+
+
+def lookup_patient_embedding(patient_id):
+    """Embedding of a patient from the patient snapshot, refreshed first to pick up patients embedded by other
+    processes (only the collection's IDs are read when nothing changed)
+
+    Returns:
+        np.ndarray: the embedding, or None if the patient was never embedded
+    """
+    matcher = state["matcher"]
+    state["patient_snapshot"] = refresh_snapshot(matcher.patient_collection, model_key=model_key(matcher.model))
+    patient_snapshot = state["patient_snapshot"]
+    return patient_snapshot.get(patient_id) if patient_snapshot is not None else None
+
+
+def add_patient_to_snapshot(patient_id, summarized_patient_profile):
+    """Embeds a summarized patient profile into ChromaDB and the patient snapshot, like
+    find_matching_trials_per_patient does
+
+    Returns:
+        np.ndarray: the patient's embedding from the refreshed snapshot
+    """
+    matcher = state["matcher"]
+    matcher.embed_and_add_single_entry(matcher.patient_collection, matcher.model, summarized_patient_profile, patient_id)
+    state["patient_snapshot"] = refresh_snapshot(matcher.patient_collection, changed_ids=[patient_id],
+                                                 model_key=model_key(matcher.model))
+    return state["patient_snapshot"].get(patient_id)
+
+
+async def embed_patient(patient_id):
+    """Looks a patient up in the snapshot, summarizing and embedding patients that were never embedded"""
+    matcher = state["matcher"]
+    loop = asyncio.get_running_loop()
+    # Snapshot refreshes write new files, so they run one at a time
+    async with state["snapshot_lock"]:
+        embedding = await loop.run_in_executor(None, lookup_patient_embedding, patient_id)
+    if embedding is not None:
+        return embedding
+
+    patient_profile_json = await loop.run_in_executor(None, matcher.create_patient_profile, patient_id)
+    summarized_patient_profile = await loop.run_in_executor(None, matcher.summarize, patient_profile_json)
+    # Encoded through the batcher with the other requests, embed_and_add_single_entry then hits the embedding cache
+    await state["batcher"].encode(summarized_patient_profile)
+    async with state["snapshot_lock"]:
+        return await loop.run_in_executor(None, add_patient_to_snapshot, patient_id, summarized_patient_profile)
+
+
+async def get_patient_embedding(patient_id):
+    """Embedding of a patient from the patient snapshot. Patients missing from it are looked up (and embedded
+    when needed) once, concurrent requests for the same patient wait on the same task.
+    """
+    patient_snapshot = state["patient_snapshot"]
+    embedding = patient_snapshot.get(patient_id) if patient_snapshot is not None else None
+    if embedding is not None:
+        return embedding
+
+    in_flight = state["in_flight"]
+    task = in_flight.get(patient_id)
+    if task is None:
+        task = asyncio.ensure_future(embed_patient(patient_id))
+        in_flight[patient_id] = task
+        task.add_done_callback(lambda _: in_flight.pop(patient_id, None))
+    return await asyncio.shield(task)
+
+
+@app.get("/match/patient/{patient_id}")
+async def match_by_patient_id(patient_id: str, top_k: int = 100, score_threshold: float = 0.1):
+    """Trials closest to an existing patient, plus the LLM verdicts already stored for that patient"""
+    try:
+        embedding = await get_patient_embedding(patient_id)
+    except IndexError:
+        raise HTTPException(status_code=404, detail=f"Patient {patient_id} not found")
+    trial_scores = await score_trials(embedding, top_k, score_threshold)
+
+    from results_store import get_results_for_patient
+    stored_results = await asyncio.get_running_loop().run_in_executor(None, get_results_for_patient, patient_id, True)
+    return {
+        "patientId": patient_id,
+        "trials": [{"trialId": trial_id, "retrievalScore": score} for trial_id, score in trial_scores],
+        "eligibleTrials": [
+            {"trialId": result['trial_id'], "trialName": result['trial_name'], "llmScore": result['llm_score']}
+            for result in stored_results
+        ]
+    }
+
+
+@app.post("/match/profile")
+async def match_by_profile(request: ProfileMatchRequest):
+    """Trials closest to a raw (already summarized) patient profile"""
+    embedding = await state["batcher"].encode(request.profile)
+    trial_scores = await score_trials(embedding, request.top_k, request.score_threshold)
+    return {"trials": [{"trialId": trial_id, "retrievalScore": score} for trial_id, score in trial_scores]}
+
+
+@app.get("/stats")
+async def stats():
+    """Latency percentiles per endpoint, batching and embedding cache statistics"""
+    model = state["matcher"].model
+    return {
+        "latency": {path: latency_summary(values) for path, values in latencies.items()},
+        "batching": state["batcher"].stats(),
+        "embedding_cache": model.cache.stats() if hasattr(model, "cache") else None
+    }
+
+
+def main():
+    import argparse
+    import uvicorn
+    parser = argparse.ArgumentParser(description="Run the clinical trial matching service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
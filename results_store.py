@@ -0,0 +1,334 @@
+import os
+import json
+import uuid
+from datetime import datetime, timezone
+from sqlalchemy import create_engine, text, event, bindparam
+
+# Indexed store for the (patient, trial) match results, replacing the per-patient JSON files as the source of truth.
+# One row per pair holding the retrieval (vector) score and the LLM verdict, indexed by patient (primary key)
+# and by trial, so both "trials for patient X" and "patients for trial Y" are single index lookups.
+# The old patient_trials_matched/patient_{id}.json files are still written through export_patient_json.
+# The status column tells pairs waiting for the LLM apart from adjudicated ones, including verdicts whose score
+# couldn't be parsed (llm_score stays NULL for those, so it can't be used to find the pending pairs).
+
+MATCH_RESULTS_DB = 'match_results.db'
+ELIGIBILITY_THRESHOLD = 0.5
+STATUS_PENDING = 'pending'
+STATUS_ADJUDICATED = 'adjudicated'
+STATUS_UNPARSEABLE = 'unparseable'
+
+_engines = {}
+
+
+def get_engine(db_path=MATCH_RESULTS_DB):
+    """Returns a (cached) SQLAlchemy engine for the results store, creating the schema if needed"""
+    if db_path not in _engines:
+        engine = create_engine(f'sqlite:///{db_path}')
+
+        @event.listens_for(engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            # WAL lets dashboards read while the batch runner is writing
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.close()
+
+        with engine.begin() as connection:
+            connection.execute(text("""
+                CREATE TABLE IF NOT EXISTS match_results (
+                    patient_id TEXT NOT NULL,
+                    trial_id TEXT NOT NULL,
+                    trial_name TEXT,
+                    retrieval_score REAL,
+                    llm_score REAL,
+                    eligible INTEGER,
+                    reasons TEXT,
+                    model TEXT,
+                    run_id TEXT,
+                    created_at TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    PRIMARY KEY (patient_id, trial_id)
+                ) WITHOUT ROWID;
+            """))
+            # Stores created before the status column: a stored score means the pair was adjudicated
+            columns = [row[1] for row in connection.execute(text("PRAGMA table_info(match_results);"))]
+            if 'status' not in columns:
+                connection.execute(text("ALTER TABLE match_results ADD COLUMN status TEXT NOT NULL DEFAULT 'pending';"))
+                connection.execute(text(f"""
+                    UPDATE match_results SET status = '{STATUS_ADJUDICATED}' WHERE llm_score IS NOT NULL;
+                """))
+            connection.execute(text("""
+                CREATE INDEX IF NOT EXISTS idx_match_results_trial
+                ON match_results (trial_id, eligible, llm_score);
+            """))
+            # Partial index over the pairs still waiting for an LLM verdict
+            connection.execute(text("DROP INDEX IF EXISTS idx_match_results_pending;"))
+            connection.execute(text(f"""
+                CREATE INDEX IF NOT EXISTS idx_match_results_status_pending
+                ON match_results (retrieval_score) WHERE status = '{STATUS_PENDING}';
+            """))
+        _engines[db_path] = engine
+    return _engines[db_path]
+
+
+def new_run_id():
+    """Unique ID for one matching run, stored with every result it produces"""
+    return f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+def _result_rows(results):
+    """Match result dicts as rows of the match_results table"""
+    created_at = datetime.now(timezone.utc).isoformat()
+    rows = []
+    for result in results:
+        llm_score = result.get('llm_score')
+        status = result.get('status') or (STATUS_PENDING if llm_score is None else STATUS_ADJUDICATED)
+        rows.append({
+            "patient_id": result['patient_id'],
+            "trial_id": result['trial_id'],
+            "trial_name": result.get('trial_name'),
+            "retrieval_score": result.get('retrieval_score'),
+            "llm_score": llm_score,
+            "eligible": None if llm_score is None else int(llm_score >= ELIGIBILITY_THRESHOLD),
+            "reasons": json.dumps(result.get('reasons') or []),
+            "model": result.get('model'),
+            "run_id": result.get('run_id'),
+            "created_at": created_at,
+            "status": status
+        })
+    return rows
+
+
+def _upsert_results(connection, rows):
+    connection.execute(text("""
+        INSERT INTO match_results (patient_id, trial_id, trial_name, retrieval_score, llm_score,
+                                   eligible, reasons, model, run_id, created_at, status)
+        VALUES (:patient_id, :trial_id, :trial_name, :retrieval_score, :llm_score,
+                :eligible, :reasons, :model, :run_id, :created_at, :status)
+        ON CONFLICT (patient_id, trial_id) DO UPDATE SET
+            trial_name = excluded.trial_name,
+            retrieval_score = excluded.retrieval_score,
+            llm_score = excluded.llm_score,
+            eligible = excluded.eligible,
+            reasons = excluded.reasons,
+            model = excluded.model,
+            run_id = excluded.run_id,
+            created_at = excluded.created_at,
+            status = excluded.status;
+    """), rows)
+
+
+def save_match_results(results, db_path=MATCH_RESULTS_DB):
+    """Bulk inserts match results, replacing any earlier result for the same (patient, trial) pair
+
+    Args:
+        results (list): dicts with patient_id, trial_id and optionally trial_name, retrieval_score,
+            llm_score, reasons (list of str), model, run_id and status (STATUS_UNPARSEABLE for verdicts without
+            a score, otherwise derived from llm_score)
+        db_path (str, optional): Defaults to MATCH_RESULTS_DB.
+
+    Returns:
+        int: Number of rows written
+    """
+    if not results:
+        return 0
+    rows = _result_rows(results)
+    with get_engine(db_path).begin() as connection:
+        _upsert_results(connection, rows)
+    return len(rows)
+
+
+def save_pending_results(results, changed_trial_ids=None, db_path=MATCH_RESULTS_DB):
+    """Merges retrieved pairs that have no LLM verdict yet (from reverse matching). A verdict already stored for
+    the same pair is kept, only the trial name, retrieval score, run ID and timestamp are updated.
+    Verdicts are only dropped for trials in changed_trial_ids, whose criteria text changed: all their earlier
+    rows are deleted first, so the retrieved pairs are adjudicated again against the new text.
+
+    Args:
+        results (list): dicts with patient_id, trial_id and optionally trial_name, retrieval_score and run_id
+        changed_trial_ids (list, optional): Trials whose stored verdicts are out of date. Defaults to None.
+        db_path (str, optional): Defaults to MATCH_RESULTS_DB.
+
+    Returns:
+        int: Number of rows written
+    """
+    rows = _result_rows([{key: value for key, value in result.items()
+                          if key not in ('llm_score', 'reasons', 'model', 'status')} for result in results])
+    invalidated_patient_ids = []
+    with get_engine(db_path).begin() as connection:
+        if changed_trial_ids:
+            trial_ids = {"trial_ids": list(changed_trial_ids)}
+            invalidated_patient_ids = [row[0] for row in connection.execute(text("""
+                SELECT DISTINCT patient_id FROM match_results WHERE trial_id IN :trial_ids AND status != :pending;
+            """).bindparams(bindparam('trial_ids', expanding=True)),
+                {**trial_ids, "pending": STATUS_PENDING}).fetchall()]
+            connection.execute(text("""
+                DELETE FROM match_results WHERE trial_id IN :trial_ids;
+            """).bindparams(bindparam('trial_ids', expanding=True)), trial_ids)
+        if rows:
+            connection.execute(text("""
+                INSERT INTO match_results (patient_id, trial_id, trial_name, retrieval_score, llm_score,
+                                           eligible, reasons, model, run_id, created_at, status)
+                VALUES (:patient_id, :trial_id, :trial_name, :retrieval_score, :llm_score,
+                        :eligible, :reasons, :model, :run_id, :created_at, :status)
+                ON CONFLICT (patient_id, trial_id) DO UPDATE SET
+                    trial_name = excluded.trial_name,
+                    retrieval_score = excluded.retrieval_score,
+                    run_id = excluded.run_id,
+                    created_at = excluded.created_at;
+            """), rows)
+    # The JSON files of these patients still list the dropped verdicts
+    for patient_id in invalidated_patient_ids:
+        export_patient_json(patient_id, db_path=db_path)
+    return len(rows)
+
+
+def replace_patient_results(patient_id, results, db_path=MATCH_RESULTS_DB):
+    """Stores a full matching run of one patient. The run scored the patient against every trial, so results
+    of earlier runs for trials it no longer selected are deleted, like the old per-patient JSON was overwritten.
+
+    Args:
+        patient_id (str): Patient ID
+        results (list): The run's result dicts, see save_match_results
+        db_path (str, optional): Defaults to MATCH_RESULTS_DB.
+
+    Returns:
+        int: Number of stale rows deleted
+    """
+    rows = _result_rows(results)
+    delete_stale = text("""
+        DELETE FROM match_results WHERE patient_id = :patient_id AND trial_id NOT IN :trial_ids;
+    """).bindparams(bindparam('trial_ids', expanding=True))
+    with get_engine(db_path).begin() as connection:
+        deleted = connection.execute(delete_stale, {"patient_id": patient_id,
+                                                    "trial_ids": [row['trial_id'] for row in rows]}).rowcount
+        if rows:
+            _upsert_results(connection, rows)
+    return deleted
+
+
+def _rows_to_dicts(rows):
+    results = []
+    for row in rows:
+        result = dict(row._mapping)
+        result['reasons'] = json.loads(result['reasons']) if result['reasons'] else []
+        results.append(result)
+    return results
+
+
+def get_results_for_patient(patient_id, eligible_only=False, db_path=MATCH_RESULTS_DB):
+    """All stored results for a patient, best LLM score first
+
+    Args:
+        patient_id (str): Patient ID
+        eligible_only (bool, optional): Only return trials the LLM judged eligible. Defaults to False.
+        db_path (str, optional): Defaults to MATCH_RESULTS_DB.
+
+    Returns:
+        list: result dicts
+    """
+    query = "SELECT * FROM match_results WHERE patient_id = :patient_id"
+    if eligible_only:
+        query += " AND eligible = 1"
+    query += " ORDER BY llm_score DESC, retrieval_score DESC;"
+    with get_engine(db_path).connect() as connection:
+        rows = connection.execute(text(query), {"patient_id": patient_id}).fetchall()
+    return _rows_to_dicts(rows)
+
+
+def get_results_for_trial(trial_id, eligible_only=True, db_path=MATCH_RESULTS_DB):
+    """All stored results for a trial ("which patients match trial X"), best LLM score first
+
+    Args:
+        trial_id (str): NCT ID of the trial
+        eligible_only (bool, optional): Only return patients the LLM judged eligible. Defaults to True.
+        db_path (str, optional): Defaults to MATCH_RESULTS_DB.
+
+    Returns:
+        list: result dicts
+    """
+    query = "SELECT * FROM match_results WHERE trial_id = :trial_id"
+    if eligible_only:
+        query += " AND eligible = 1"
+    query += " ORDER BY llm_score DESC, retrieval_score DESC;"
+    with get_engine(db_path).connect() as connection:
+        rows = connection.execute(text(query), {"trial_id": trial_id}).fetchall()
+    return _rows_to_dicts(rows)
+
+
+def get_pending_results(limit=None, db_path=MATCH_RESULTS_DB):
+    """Pairs that were retrieved but not sent to the LLM yet (e.g. added by reverse matching), best retrieval score first.
+    Adjudicated pairs whose score couldn't be parsed are not pending, they aren't sent to the LLM again.
+
+    Args:
+        limit (int, optional): Maximum number of pairs to return. Defaults to None (all).
+        db_path (str, optional): Defaults to MATCH_RESULTS_DB.
+
+    Returns:
+        list: result dicts
+    """
+    query = "SELECT * FROM match_results WHERE status = :pending ORDER BY retrieval_score DESC"
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    with get_engine(db_path).connect() as connection:
+        rows = connection.execute(text(query + ";"), {"pending": STATUS_PENDING}).fetchall()
+    return _rows_to_dicts(rows)
+
+
+def patient_results_to_json(patient_id, db_path=MATCH_RESULTS_DB):
+    """Builds the legacy per-patient JSON (patientId + eligibleTrials) from the store.
+    Rejected trials are left out instead of showing up as null entries.
+
+    Args:
+        patient_id (str): Patient ID
+        db_path (str, optional): Defaults to MATCH_RESULTS_DB.
+
+    Returns:
+        dict: {"patientId": ..., "eligibleTrials": [{"trialId", "trialName", "eligibilityCriteriaMet"}]}
+    """
+    return {
+        "patientId": patient_id,
+        "eligibleTrials": [
+            {
+                "trialId": result['trial_id'],
+                "trialName": result['trial_name'],
+                "eligibilityCriteriaMet": result['reasons']
+            }
+            for result in get_results_for_patient(patient_id, eligible_only=True, db_path=db_path)
+        ]
+    }
+
+
+def export_patient_json(patient_id, output_dir='patient_trials_matched', db_path=MATCH_RESULTS_DB):
+    """Writes patient_trials_matched/patient_{id}.json from the store, for consumers of the old file layout
+
+    Returns:
+        str: path of the written file
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    filename = os.path.join(output_dir, f'patient_{patient_id}.json')
+    with open(filename, 'w') as json_file:
+        json.dump(patient_results_to_json(patient_id, db_path), json_file, indent=2)
+    return filename
+
+
+def export_all_json(output_dir='patient_trials_matched', db_path=MATCH_RESULTS_DB):
+    """Writes the legacy JSON file of every patient that has results in the store
+
+    Returns:
+        int: Number of files written
+    """
+    with get_engine(db_path).connect() as connection:
+        patient_ids = [row[0] for row in connection.execute(text(
+            "SELECT DISTINCT patient_id FROM match_results;")).fetchall()]
+    for patient_id in patient_ids:
+        export_patient_json(patient_id, output_dir, db_path)
+    return len(patient_ids)
+
+
+def main():
+    print(f"Exported {export_all_json()} patient JSON files to ./patient_trials_matched")
+
+
+if __name__ == "__main__":
+    main()
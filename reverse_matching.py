@@ -0,0 +1,165 @@
+import chromadb
+import numpy as np
+from create_clinical_trial_embeddings import get_or_create_collection
+from results_store import new_run_id, save_pending_results
+from embedding_snapshot import refresh_snapshot
+from instrumentation import span, count
+
+# Trial -> patients matching. When the scraper indexes new trials, only those trials are scored against the
+# already embedded patients (instead of re-running find_matching_trial.py for the whole cohort).
+# The retrieval scores are merged into the results store as pending pairs (status 'pending'),
+# find_matching_trial.adjudicate_pending_results() later runs the LLM verdict on just those pairs.
+# Verdicts already stored for a pair are kept (e.g. trials re-scraped after a ChromaDB wipe), unless the
+# trial is passed as changed because its criteria text changed.
+
+
+def get_patient_collection():
+    """Returns the patient_data collection of the local ChromaDB"""
+    client = chromadb.PersistentClient(path="./chromadb_clinicaltrial")
+    return get_or_create_collection(client, "patient_data")
+
+
+def _get_embeddings(collection, ids):
+    """Fetches embeddings for the given IDs as a dict of ID -> normalized float32 vector"""
+    result = collection.get(ids=ids, include=['embeddings'])
+    vectors = np.asarray(result['embeddings'], dtype=np.float32).reshape(len(result['ids']), -1)
+    vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+    return dict(zip(result['ids'], vectors))
+
+
+def _candidates_from_snapshot(inclusion_embeddings, patient_snapshot, top_k, batch_size=256):
+    """Top_k patients of each trial by inclusion similarity, scored against the memory-mapped patient snapshot
+
+    Yields:
+        tuple: (patient IDs, their normalized embeddings) for each trial, in the order of inclusion_embeddings
+    """
+    top_k = min(top_k, len(patient_snapshot))
+    for start in range(0, len(inclusion_embeddings), batch_size):
+        with span('snapshot.score_patients'):
+            similarity = inclusion_embeddings[start:start + batch_size] @ patient_snapshot.vectors.T
+            top_rows = np.argpartition(-similarity, top_k - 1, axis=1)[:, :top_k]
+        count('vectors.scored', similarity.size)
+        for rows in top_rows:
+            yield [patient_snapshot.ids[row] for row in rows], np.asarray(patient_snapshot.vectors[rows])
+
+
+def _candidates_from_chromadb(inclusion_embeddings, patient_collection, top_k):
+    """Top_k patients of each trial by inclusion similarity, from one ChromaDB query for all the trials"""
+    n_patients = patient_collection.count()
+    if n_patients == 0:
+        return
+    with span('chromadb.query'):
+        patient_matches = patient_collection.query(
+            query_embeddings=inclusion_embeddings.tolist(),
+            include=['embeddings'],
+            n_results=min(top_k, n_patients)
+        )
+    for patient_ids, patient_embeddings in zip(patient_matches['ids'], patient_matches['embeddings']):
+        patient_embeddings = np.asarray(patient_embeddings, dtype=np.float32).reshape(len(patient_ids), -1)
+        patient_embeddings /= np.clip(np.linalg.norm(patient_embeddings, axis=1, keepdims=True), 1e-12, None)
+        yield patient_ids, patient_embeddings
+
+
+def find_matching_patients_per_trial(trial_ids, inclusion_collection, exclusion_collection, patient_collection,
+                                     top_k=100, score_threshold=0.1, patient_snapshot=None):
+    """Finds the closest patients for each of the given trials. Mirrors the patient -> trials scoring:
+    the top_k patients by similarity to the inclusion criteria are scored as
+    similarity(inclusion) - similarity(exclusion), and pairs above score_threshold are kept.
+
+    Args:
+        trial_ids (list): NCT IDs of the new or updated trials
+        inclusion_collection (chromadb.collection): inclusion_criteria collection
+        exclusion_collection (chromadb.collection): exclusion_criteria collection
+        patient_collection (chromadb.collection): patient_data collection
+        top_k (int, optional): Number of closest patients per trial. Defaults to 100.
+        score_threshold (float, optional): Minimum score to keep a pair. Defaults to 0.1.
+        patient_snapshot (EmbeddingSnapshot, optional): Snapshot of patient_data to score against instead of
+            querying ChromaDB. Defaults to None.
+
+    Returns:
+        list: (patient_id, trial_id, score) tuples
+    """
+    if not trial_ids:
+        return []
+    inclusion = inclusion_collection.get(ids=trial_ids, include=['embeddings'])
+    trial_ids = inclusion['ids']
+    if not trial_ids:
+        return []
+    inclusion_embeddings = np.asarray(inclusion['embeddings'], dtype=np.float32).reshape(len(trial_ids), -1)
+    inclusion_embeddings /= np.clip(np.linalg.norm(inclusion_embeddings, axis=1, keepdims=True), 1e-12, None)
+    exclusion_embeddings = _get_embeddings(exclusion_collection, trial_ids)
+
+    if patient_snapshot is not None and len(patient_snapshot):
+        candidates = _candidates_from_snapshot(inclusion_embeddings, patient_snapshot, top_k)
+    else:
+        candidates = _candidates_from_chromadb(inclusion_embeddings, patient_collection, top_k)
+
+    pairs = []
+    for trial_id, inclusion_embedding, (patient_ids, patient_embeddings) in zip(
+            trial_ids, inclusion_embeddings, candidates):
+        if not patient_ids:
+            continue
+
+        # Inclusion similarity and exclusion penalty for all the candidate patients at once
+        scores = patient_embeddings @ inclusion_embedding
+        exclusion_embedding = exclusion_embeddings.get(trial_id)
+        if exclusion_embedding is not None:
+            scores -= patient_embeddings @ exclusion_embedding
+        count('vectors.scored', len(patient_ids) * (1 if exclusion_embedding is None else 2))
+
+        for patient_id, score in zip(patient_ids, scores):
+            if score > score_threshold:
+                pairs.append((patient_id, trial_id, float(score)))
+    return pairs
+
+
+def match_new_trials_to_patients(trial_ids, inclusion_collection, exclusion_collection, patient_collection=None,
+                                 top_k=100, score_threshold=0.1, changed_trial_ids=None, model_key=None):
+    """Scores new or updated trials against the existing patients and merges the resulting (patient, trial)
+    pairs into the results store, waiting for LLM adjudication.
+
+    Args:
+        trial_ids (list): NCT IDs of the new or updated trials
+        inclusion_collection (chromadb.collection): inclusion_criteria collection
+        exclusion_collection (chromadb.collection): exclusion_criteria collection
+        patient_collection (chromadb.collection, optional): Defaults to the local patient_data collection.
+        top_k (int, optional): Number of closest patients per trial. Defaults to 100.
+        score_threshold (float, optional): Minimum score to keep a pair. Defaults to 0.1.
+        changed_trial_ids (list, optional): Trials among trial_ids whose criteria text changed, their stored
+            verdicts are dropped and re-adjudicated. Defaults to None.
+        model_key (str, optional): embedding_cache.model_key of the model in use, the patient snapshot is rebuilt
+            when it was written for another model. Defaults to None (not checked).
+
+    Returns:
+        list: (patient_id, trial_id, score) tuples that were merged into the results store
+    """
+    if patient_collection is None:
+        patient_collection = get_patient_collection()
+    # Same ID check as the trial snapshot, only patients added since the last refresh are fetched
+    patient_snapshot = refresh_snapshot(patient_collection, model_key=model_key)
+    pairs = find_matching_patients_per_trial(trial_ids, inclusion_collection, exclusion_collection,
+                                             patient_collection, top_k, score_threshold, patient_snapshot)
+    if not pairs:
+        save_pending_results([], changed_trial_ids)
+        return pairs
+
+    trial_names = {}
+    matched_trial_ids = list({trial_id for _, trial_id, _ in pairs})
+    trial_metadata = inclusion_collection.get(ids=matched_trial_ids, include=['metadatas'])
+    for trial_id, metadata in zip(trial_metadata['ids'], trial_metadata['metadatas']):
+        trial_names[trial_id] = (metadata or {}).get('study_title')
+
+    run_id = new_run_id()
+    save_pending_results([
+        {
+            "patient_id": patient_id,
+            "trial_id": trial_id,
+            "trial_name": trial_names.get(trial_id),
+            "retrieval_score": score,
+            "run_id": run_id
+        }
+        for patient_id, trial_id, score in pairs
+    ], changed_trial_ids)
+    print(f"Reverse matching: {len(pairs)} (patient, trial) pairs from {len(trial_ids)} trials "
+          f"added to the results store, pending LLM adjudication")
+    return pairs
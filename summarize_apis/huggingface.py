@@ -1,9 +1,11 @@
 from huggingface_hub import InferenceClient
 from dotenv import load_dotenv
 import os
+from instrumentation import span, count
 
 load_dotenv()
-client = InferenceClient(api_key=os.getenv('HUGGINGFACE_KEY'))
+# HUGGINGFACE_BASE_URL points the client at another chat completions server, e.g. fake_llm_server.py
+client = InferenceClient(api_key=os.getenv('HUGGINGFACE_KEY'), base_url=os.getenv('HUGGINGFACE_BASE_URL'))
 
 def summarize(info, agent_prompt=True, model='meta-llama/Llama-3.2-3B-Instruct', max_tokens=2000):
 	if agent_prompt:
@@ -19,13 +21,18 @@ def summarize(info, agent_prompt=True, model='meta-llama/Llama-3.2-3B-Instruct',
 						"""
 	else:
 		agent_prompt = ''
-	response = client.chat_completion(
-        model=model,
-        messages=[{"role": "user", "content": f"{agent_prompt} : {info}"}],
-		max_tokens=max_tokens,
-        temperature=0.2,
-        stream=False
-    )
+	with span('llm.chat_completion'):
+		response = client.chat_completion(
+			model=model,
+			messages=[{"role": "user", "content": f"{agent_prompt} : {info}"}],
+			max_tokens=max_tokens,
+			temperature=0.2,
+			stream=False
+		)
+	count('llm.calls')
+	if getattr(response, 'usage', None) is not None:
+		count('llm.tokens_in', response.usage.prompt_tokens or 0)
+		count('llm.tokens_out', response.usage.completion_tokens or 0)
 	# print(response.choices[0].message.content)
 	return response.choices[0].message.content
 
@@ -1,4 +1,6 @@
+import os
 import requests
+from instrumentation import span, count
 
 def summarize(data: str, model="llama3.2-1b-medical-v1", stream=False):
     """General function to summarize given data using LLM API
@@ -12,7 +14,7 @@ def summarize(data: str, model="llama3.2-1b-medical-v1", stream=False):
         str : The output of the model from the api
     """
 
-    url = "http://127.0.0.1:1234/v1/chat/completions"
+    url = os.getenv('OLLAMA_URL', "http://127.0.0.1:1234/v1/chat/completions")
     headers = {
         "Content-Type": "application/json"
     }
@@ -39,16 +41,22 @@ def summarize(data: str, model="llama3.2-1b-medical-v1", stream=False):
         "stream": stream
     }
 
-    response = requests.post(url, headers=headers, json=data, stream=True)
-    if stream:
-        chunks = []
-        for chunk in response.iter_lines():
-            if chunk:
-                chunks.append(chunk.decode('utf-8'))
-        return ' '.join(chunks)
-
-    else:
-        return response.json()
+    with span('llm.chat_completion'):
+        response = requests.post(url, headers=headers, json=data, stream=True)
+        if stream:
+            chunks = []
+            for chunk in response.iter_lines():
+                if chunk:
+                    chunks.append(chunk.decode('utf-8'))
+            count('llm.calls')
+            return ' '.join(chunks)
+        response_json = response.json()
+    # The token usage is only reported in the non-streamed response
+    count('llm.calls')
+    usage = response_json.get('usage') or {}
+    count('llm.tokens_in', usage.get('prompt_tokens') or 0)
+    count('llm.tokens_out', usage.get('completion_tokens') or 0)
+    return response_json
     # print(respo)
 
 def main():
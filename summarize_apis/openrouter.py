@@ -2,6 +2,7 @@ import json
 import requests
 from dotenv import load_dotenv
 import os
+from instrumentation import span, count
 
 def summarize(info, model="meta-llama/llama-3.2-3b-instruct:free"):
     """General function to summarize given data using LLM API
@@ -15,7 +16,8 @@ def summarize(info, model="meta-llama/llama-3.2-3b-instruct:free"):
     """
     
     load_dotenv('./.env')
-    url = "https://openrouter.ai/api/v1/chat/completions"
+    # OPENROUTER_URL points it at another chat completions server, e.g. fake_llm_server.py
+    url = os.getenv('OPENROUTER_URL', "https://openrouter.ai/api/v1/chat/completions")
     headers = {
         "Authorization": f"Bearer {os.getenv('OPENROUTER_KEY')}",
         "Content-Type": "application/json"
@@ -42,10 +44,16 @@ def summarize(info, model="meta-llama/llama-3.2-3b-instruct:free"):
         ]
     }
     
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    with span('llm.chat_completion'):
+        response = requests.post(url, headers=headers, data=json.dumps(data))
+    count('llm.calls')
     
     if response.status_code == 200:
-        assistant_message = response.json()['choices'][0]['message']['content']
+        response_json = response.json()
+        usage = response_json.get('usage') or {}
+        count('llm.tokens_in', usage.get('prompt_tokens') or 0)
+        count('llm.tokens_out', usage.get('completion_tokens') or 0)
+        assistant_message = response_json['choices'][0]['message']['content']
         return assistant_message
     else:
         print(f"Error: {response.status_code}, {response.text}")
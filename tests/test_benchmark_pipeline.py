@@ -0,0 +1,48 @@
+import json
+import os
+import socket
+import pytest
+from benchmark_pipeline import run_benchmark, compare_to_baseline
+from embedding_backends import EMBEDDING_MODEL_NAME
+
+# Smoke test of the offline benchmark: a tiny synthetic corpus through every stage, with fake_llm_server.py
+# answering the LLM and trials API calls. Needs the pipeline's dependencies and the MiniLM model in the local
+# HuggingFace cache, nothing is downloaded.
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_run_benchmark_smoke(tmp_path, monkeypatch):
+    for module in ('pandas', 'chromadb', 'sentence_transformers', 'dotenv', 'huggingface_hub', 'tqdm'):
+        pytest.importorskip(module)
+    from huggingface_hub import try_to_load_from_cache
+    if not isinstance(try_to_load_from_cache(EMBEDDING_MODEL_NAME, "config.json"), str):
+        pytest.skip(f"{EMBEDDING_MODEL_NAME} is not in the local HuggingFace cache")
+    monkeypatch.setenv('HF_HUB_OFFLINE', '1')
+
+    workdir = tmp_path / 'run'
+    report = run_benchmark(str(workdir), n_patients=20, n_trials=30, match_patients=2, adjudicate=5,
+                           port=free_port(), seed=1)
+
+    stages = report["stages"]
+    assert list(stages) == ['generate', 'ingest', 'embed', 'retrieve', 'adjudicate']
+    assert stages["ingest"]["items"] == 20
+    assert stages["embed"]["spans"]["chromadb.upsert"]["count"] > 0
+    assert stages["retrieve"]["items"] == 2
+    assert 0 < stages["adjudicate"]["items"] <= 5
+    assert all(result["items_per_s"] for result in stages.values())
+    with open(workdir / 'benchmark_report.json') as report_file:
+        assert json.load(report_file) == report
+    assert os.path.exists(workdir / 'patient_data.db')
+
+
+def test_compare_to_baseline():
+    baseline = {"stages": {"ingest": {"items_per_s": 100.0}, "embed": {"items_per_s": 50.0},
+                           "retrieve": {"items_per_s": None}}}
+    report = {"stages": {"ingest": {"items_per_s": 85.0}, "embed": {"items_per_s": 30.0},
+                         "retrieve": {"items_per_s": 1.0}, "adjudicate": {"items_per_s": 2.0}}}
+    assert compare_to_baseline(report, baseline, tolerance=0.2) == [("embed", 50.0, 30.0)]
@@ -0,0 +1,63 @@
+import sqlite3
+from combine_patient_data import refresh_patient_features, replace_tracked_table
+
+# Change tracking of the patient feature table: triggers for edits in SQLite, a diff for CSV re-imports
+
+
+def create_patient_db(db_path):
+    connection = sqlite3.connect(db_path)
+    connection.executescript("""
+        CREATE TABLE patients (id TEXT, birthdate TEXT, gender TEXT);
+        INSERT INTO patients VALUES ('a', '1980-01-01', 'M'), ('b', '1990-02-02', 'F');
+        CREATE TABLE observations (patient TEXT, date TEXT, category TEXT, description TEXT, value TEXT,
+                                   units TEXT, type TEXT);
+        INSERT INTO observations VALUES ('a', '2024-01-01', 'vital-signs', 'Body Weight', '68.0', 'kg', 'numeric'),
+                                        ('b', '2024-01-01', 'vital-signs', 'Body Weight', '50.0', 'kg', 'numeric');
+        CREATE TABLE conditions (patient TEXT, description TEXT);
+        INSERT INTO conditions VALUES ('a', 'Diabetes');
+    """)
+    connection.commit()
+    return connection
+
+
+def test_edits_in_sqlite_refresh_only_the_patient(tmp_path):
+    db_path = tmp_path / 'patient_data.db'
+    connection = create_patient_db(db_path)
+    db_url = f'sqlite:///{db_path}'
+    assert refresh_patient_features(db_url=db_url) == 2
+    assert refresh_patient_features(db_url=db_url) == 0
+
+    # Same length edit, missed by a row count / length fingerprint
+    connection.execute("UPDATE observations SET value = '69.0' WHERE patient = 'a';")
+    connection.commit()
+    assert refresh_patient_features(db_url=db_url) == 1
+    value = connection.execute("SELECT observations FROM patient_features WHERE patient_id = 'a';").fetchone()[0]
+    assert '69.0' in value
+
+    connection.execute("DELETE FROM patients WHERE id = 'b';")
+    connection.commit()
+    assert refresh_patient_features(db_url=db_url) == 0
+    assert connection.execute("SELECT COUNT(*) FROM patient_features;").fetchone()[0] == 1
+
+
+def test_reimport_marks_only_changed_patients(tmp_path):
+    db_path = tmp_path / 'patient_data.db'
+    connection = create_patient_db(db_path)
+    db_url = f'sqlite:///{db_path}'
+    refresh_patient_features(db_url=db_url)
+
+    connection.execute("CREATE TABLE conditions_import AS SELECT * FROM conditions;")
+    connection.commit()
+    assert replace_tracked_table('conditions', 'conditions_import', db_url) == 0
+    assert refresh_patient_features(db_url=db_url) == 0
+
+    connection.execute("CREATE TABLE conditions_import AS SELECT * FROM conditions;")
+    connection.execute("INSERT INTO conditions_import VALUES ('b', 'Hypertension');")
+    connection.commit()
+    assert replace_tracked_table('conditions', 'conditions_import', db_url) == 1
+    assert refresh_patient_features(db_url=db_url) == 1
+
+    # The swapped in table is tracked again
+    connection.execute("DELETE FROM conditions WHERE patient = 'a';")
+    connection.commit()
+    assert refresh_patient_features(db_url=db_url) == 1
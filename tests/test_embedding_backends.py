@@ -0,0 +1,36 @@
+import pytest
+
+pytest.importorskip("sentence_transformers")
+import embedding_backends
+from embedding_backends import EMBEDDING_MODEL_NAME, get_embedding_model, check_parity, sample_texts
+
+# Parity of the quantized and ONNX backends against the fp32 torch encoder, the same check
+# `python embedding_backends.py --backend ...` runs before switching EMBEDDING_BACKEND.
+# Needs the MiniLM model in the local HuggingFace cache, nothing is downloaded.
+
+
+@pytest.fixture(scope="module")
+def reference_model():
+    from huggingface_hub import try_to_load_from_cache
+    if not isinstance(try_to_load_from_cache(EMBEDDING_MODEL_NAME, "config.json"), str):
+        pytest.skip(f"{EMBEDDING_MODEL_NAME} is not in the local HuggingFace cache")
+    return get_embedding_model('torch')
+
+
+@pytest.fixture(scope="module")
+def onnx_model_dir(tmp_path_factory):
+    # Exported graphs go to a temporary directory instead of ./onnx_models
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(embedding_backends, 'ONNX_MODEL_DIR', str(tmp_path_factory.mktemp("onnx_models")))
+        yield
+
+
+@pytest.mark.parametrize("backend", ['torch-int8', 'onnx', 'onnx-int8'])
+def test_backend_parity(backend, reference_model, request):
+    if backend.startswith('onnx'):
+        pytest.importorskip("onnxruntime")
+        request.getfixturevalue('onnx_model_dir')
+    candidate_model = get_embedding_model(backend)
+    parity = check_parity(reference_model, candidate_model, sample_texts(64))
+    assert parity["passed"], parity
+    assert candidate_model.encode("Adults with type 2 diabetes mellitus").shape == (384,)
@@ -0,0 +1,55 @@
+import sqlite3
+from results_store import (save_pending_results, save_match_results, get_pending_results, get_results_for_patient,
+                           get_engine, STATUS_PENDING, STATUS_ADJUDICATED, STATUS_UNPARSEABLE)
+
+
+def pending_pairs(db_path):
+    return [(result['patient_id'], result['trial_id']) for result in get_pending_results(db_path=db_path)]
+
+
+def test_unparseable_verdict_leaves_the_pending_queue(tmp_path):
+    db_path = str(tmp_path / 'match_results.db')
+    save_pending_results([
+        {"patient_id": "p1", "trial_id": "NCT1", "retrieval_score": 0.9},
+        {"patient_id": "p1", "trial_id": "NCT2", "retrieval_score": 0.5},
+    ], db_path=db_path)
+    assert pending_pairs(db_path) == [("p1", "NCT1"), ("p1", "NCT2")]
+
+    # The LLM answered, but the first line wasn't a score
+    save_match_results([{"patient_id": "p1", "trial_id": "NCT1", "retrieval_score": 0.9, "llm_score": None,
+                         "reasons": ["Not sure."], "status": STATUS_UNPARSEABLE}], db_path=db_path)
+    assert pending_pairs(db_path) == [("p1", "NCT2")]
+    statuses = {result['trial_id']: result['status'] for result in get_results_for_patient("p1", db_path=db_path)}
+    assert statuses == {"NCT1": STATUS_UNPARSEABLE, "NCT2": STATUS_PENDING}
+
+
+def test_pending_upsert_keeps_verdicts(tmp_path):
+    db_path = str(tmp_path / 'match_results.db')
+    save_match_results([{"patient_id": "p1", "trial_id": "NCT1", "retrieval_score": 0.9, "llm_score": 0.8}],
+                       db_path=db_path)
+    save_pending_results([{"patient_id": "p1", "trial_id": "NCT1", "retrieval_score": 0.7}], db_path=db_path)
+    result, = get_results_for_patient("p1", db_path=db_path)
+    assert (result['llm_score'], result['retrieval_score'], result['status']) == (0.8, 0.7, STATUS_ADJUDICATED)
+    assert pending_pairs(db_path) == []
+
+    # Only a change of the trial text sends the pair back to the LLM
+    save_pending_results([{"patient_id": "p1", "trial_id": "NCT1", "retrieval_score": 0.7}],
+                         changed_trial_ids=["NCT1"], db_path=db_path)
+    assert pending_pairs(db_path) == [("p1", "NCT1")]
+
+
+def test_status_added_to_an_existing_store(tmp_path):
+    db_path = str(tmp_path / 'match_results.db')
+    connection = sqlite3.connect(db_path)
+    connection.execute("""
+        CREATE TABLE match_results (patient_id TEXT NOT NULL, trial_id TEXT NOT NULL, trial_name TEXT,
+            retrieval_score REAL, llm_score REAL, eligible INTEGER, reasons TEXT, model TEXT, run_id TEXT,
+            created_at TEXT, PRIMARY KEY (patient_id, trial_id)) WITHOUT ROWID;
+    """)
+    connection.execute("INSERT INTO match_results (patient_id, trial_id, retrieval_score, llm_score) "
+                       "VALUES ('p1', 'NCT1', 0.9, 0.7), ('p1', 'NCT2', 0.5, NULL);")
+    connection.commit()
+    connection.close()
+
+    get_engine(db_path)
+    assert pending_pairs(db_path) == [("p1", "NCT2")]
@@ -0,0 +1,97 @@
+import asyncio
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from trial_api_client import create_session, fetch_recruiting_trials
+from trial_parsing import study_to_trial_details, extract_title, extract_inclusion_criteria, extract_exclusion_criteria
+
+# fetch_recruiting_trials against a small local stand-in for the clinicaltrials.gov API v2, no network access needed
+
+
+def make_study(index):
+    return {
+        "protocolSection": {
+            "identificationModule": {
+                "nctId": f"NCT{index:08d}",
+                "briefTitle": f"Study {index}",
+                "officialTitle": f"A Randomized  Study of\nDrug {index} in Adults"
+            },
+            "descriptionModule": {"briefSummary": f"Summary of study {index}."},
+            "conditionsModule": {"conditions": ["Diabetes", "Hypertension"]},
+            "eligibilityModule": {
+                "eligibilityCriteria": f"Inclusion Criteria:\n\n* Age 18 or older\n* Diagnosed with condition {index}\n\n"
+                                       f"Exclusion Criteria:\n\n* Pregnancy\n* Prior treatment with drug {index}"
+            }
+        }
+    }
+
+
+@pytest.fixture
+def studies_api():
+    """A /api/v2/studies endpoint paging through 25 studies
+
+    Returns:
+        tuple: (function building a fresh aiohttp app, the studies served, query of every request received)
+    """
+    studies = [make_study(index) for index in range(25)]
+    requests = []
+
+    async def list_studies(request):
+        requests.append(dict(request.query))
+        page_size = int(request.query['pageSize'])
+        # Opaque tokens, like the real API
+        start = int(request.query['pageToken'].removeprefix('token-')) if 'pageToken' in request.query else 0
+        page = {"studies": studies[start:start + page_size]}
+        if start + page_size < len(studies):
+            page["nextPageToken"] = f"token-{start + page_size}"
+        return web.json_response(page)
+
+    def make_app():
+        app = web.Application()
+        app.router.add_get('/api/v2/studies', list_studies)
+        return app
+
+    return make_app, studies, requests
+
+
+def fetch_pages(make_app, trials_per_page, max_pages):
+    async def run():
+        async with TestServer(make_app()) as server:
+            async with create_session() as session:
+                return [studies async for studies in fetch_recruiting_trials(
+                    session, trials_per_page, max_pages, str(server.make_url('/api/v2')))]
+    return asyncio.run(run())
+
+
+def test_fetches_every_page(studies_api):
+    make_app, studies, requests = studies_api
+    pages = fetch_pages(make_app, trials_per_page=10, max_pages=None)
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [study for page in pages for study in page] == studies
+    assert [request.get('pageToken') for request in requests] == [None, 'token-10', 'token-20']
+    assert all(request['filter.overallStatus'] == 'RECRUITING' for request in requests)
+
+
+def test_max_pages(studies_api):
+    make_app, _, requests = studies_api
+    assert [len(page) for page in fetch_pages(make_app, 10, max_pages=2)] == [10, 10]
+    assert len(requests) == 2
+    # web_scraper_trials.py --max-pages 1 passes 0, and fetches nothing like the browser mode
+    assert fetch_pages(make_app, 10, max_pages=0) == []
+    assert len(requests) == 2
+
+
+def test_study_to_trial_details():
+    nct_id, details = study_to_trial_details(make_study(3))
+    assert nct_id == "NCT00000003"
+    assert extract_title(details["Study Overview"]) == "A Randomized Study of Drug 3 in Adults"
+    assert extract_inclusion_criteria(details["Participation Criteria"]) == (
+        "* Age 18 or older\n* Diagnosed with condition 3")
+    assert extract_exclusion_criteria(details["Participation Criteria"]) == (
+        "* Pregnancy\n* Prior treatment with drug 3")
+
+
+def test_study_to_trial_details_missing_fields():
+    nct_id, details = study_to_trial_details({"protocolSection": {"identificationModule": {"nctId": "NCT00000001"}}})
+    assert nct_id == "NCT00000001"
+    assert details["Participation Criteria"] == ''
@@ -0,0 +1,63 @@
+import asyncio
+import aiohttp
+from tenacity import retry, stop_after_attempt, wait_exponential
+from trial_parsing import study_to_trial_details
+
+# Lightweight alternative to the headless browser in web_scraper_trials.py: pulls structured trial records as
+# JSON from the clinicaltrials.gov API (v2) over plain HTTP. Trials are mapped to the same
+# "Study Overview" / "Participation Criteria" fields the browser extraction produces, so extract_title and the
+# criteria regexes work unchanged. Select it with `python web_scraper_trials.py --fetch-mode http`.
+# The listing is paged with opaque nextPageToken values, so pages can't be requested in parallel. Instead the
+# fetch is pipelined: the next page is downloaded while the current one is embedded, over one kept-alive connection.
+
+CLINICAL_TRIALS_API_URL = 'https://clinicaltrials.gov/api/v2'
+STUDY_FIELDS = ['NCTId', 'BriefTitle', 'OfficialTitle', 'BriefSummary', 'Condition', 'EligibilityCriteria']
+
+
+def create_session():
+    """HTTP session shared by all the requests of a scrape, so the connection is reused between pages"""
+    connector = aiohttp.TCPConnector(ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=60)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, raise_for_status=True)
+
+
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
+async def fetch_json(session, url, params=None):
+    """GET a JSON document, retried like the browser fetches"""
+    async with session.get(url, params=params) as response:
+        return await response.json(content_type=None)
+
+
+async def fetch_recruiting_trials(session, trials_per_page=50, max_pages=None, base_url=CLINICAL_TRIALS_API_URL):
+    """Pages through the currently recruiting trials. The next page is requested while the caller
+    processes the current one, so at most one request is in flight.
+
+    Args:
+        session (aiohttp.ClientSession): Session from create_session()
+        trials_per_page (int, optional): Page size. Defaults to 50.
+        max_pages (int, optional): Stop after this many pages, 0 fetches nothing. Defaults to None (all pages).
+        base_url (str, optional): API base URL, e.g. a local fixture server. Defaults to CLINICAL_TRIALS_API_URL.
+
+    Yields:
+        list: the studies of one page
+    """
+    params = {
+        "filter.overallStatus": "RECRUITING",
+        "pageSize": trials_per_page,
+        "fields": ','.join(STUDY_FIELDS),
+        "format": "json"
+    }
+    if max_pages is not None and max_pages <= 0:
+        return
+    next_page = asyncio.ensure_future(fetch_json(session, f"{base_url}/studies", params))
+    pages = 0
+    while next_page is not None:
+        page = await next_page
+        pages += 1
+        next_page = None
+        page_token = page.get('nextPageToken')
+        if page_token and (max_pages is None or pages < max_pages):
+            next_page = asyncio.ensure_future(fetch_json(session, f"{base_url}/studies",
+                                                         {**params, "pageToken": page_token}))
+        yield page.get('studies', [])
+
@@ -0,0 +1,244 @@
+import os
+import gzip
+import json
+import hashlib
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+from trial_parsing import (extract_trial_page, study_to_trial_details, extract_title, extract_inclusion_criteria,
+                           extract_exclusion_criteria)
+
+# Compressed, content-addressed archive of everything the scraper fetched, so a parser fix never needs a re-crawl.
+# Every fetched trial is stored as objects/<sha[:2]>/<sha256>.json.gz, holding the extracted fields and the raw
+# page (HTML or API JSON). index.jsonl appends one line per fetch with the trial ID, object hash and fetch time,
+# the last line of a trial wins. Identical content maps to the same object, so re-fetching unchanged trials is free.
+# `python trial_archive.py reparse` rebuilds the trial records and embeddings from the archive using all cores,
+# re-extracting the fields from the raw page so fixes to the extraction itself are picked up too.
+
+TRIAL_ARCHIVE_DIR = './trial_archive'
+
+
+def _object_path(sha, archive_dir):
+    return os.path.join(archive_dir, 'objects', sha[:2], f'{sha}.json.gz')
+
+
+def archive_trial_page(trial_id, extracted, raw=None, source='browser', url=None, archive_dir=TRIAL_ARCHIVE_DIR):
+    """Stores a fetched trial in the archive
+
+    Args:
+        trial_id (str): NCT ID of the trial
+        extracted (dict): Extracted fields, "Study Overview" and "Participation Criteria"
+        raw (str, optional): The raw fetched page (HTML or API JSON). Defaults to None.
+        source (str, optional): Fetch backend, 'browser' or 'http'. Defaults to 'browser'.
+        url (str, optional): URL the trial was fetched from. Defaults to None.
+        archive_dir (str, optional): Defaults to TRIAL_ARCHIVE_DIR.
+
+    Returns:
+        str: sha256 of the stored object
+    """
+    payload = json.dumps({
+        "trial_id": trial_id,
+        "source": source,
+        "url": url,
+        "extracted": extracted,
+        "raw": raw
+    }, sort_keys=True).encode('utf-8')
+    sha = hashlib.sha256(payload).hexdigest()
+
+    os.makedirs(archive_dir, exist_ok=True)
+    object_path = _object_path(sha, archive_dir)
+    if not os.path.exists(object_path):
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        with gzip.open(object_path + '.tmp', 'wb') as object_file:
+            object_file.write(payload)
+        os.replace(object_path + '.tmp', object_path)
+
+    entry = {"trial_id": trial_id, "sha256": sha, "fetched_at": datetime.now(timezone.utc).isoformat(), "source": source}
+    with open(os.path.join(archive_dir, 'index.jsonl'), 'a') as index_file:
+        index_file.write(json.dumps(entry) + '\n')
+    return sha
+
+
+def load_archive_index(archive_dir=TRIAL_ARCHIVE_DIR):
+    """Reads the archive index
+
+    Returns:
+        dict: trial ID -> latest index entry (trial_id, sha256, fetched_at, source)
+    """
+    index = {}
+    index_path = os.path.join(archive_dir, 'index.jsonl')
+    if not os.path.exists(index_path):
+        return index
+    with open(index_path) as index_file:
+        for line in index_file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:  # Partially written last line
+                continue
+            index[entry['trial_id']] = entry
+    return index
+
+
+def read_archived_trial(sha, archive_dir=TRIAL_ARCHIVE_DIR):
+    """Reads an archived trial by its hash
+
+    Returns:
+        dict: trial_id, source, url, extracted and raw fields as stored by archive_trial_page
+    """
+    with gzip.open(_object_path(sha, archive_dir), 'rb') as object_file:
+        return json.loads(object_file.read())
+
+
+def extract_from_raw(archived_trial):
+    """Re-extracts "Study Overview" and "Participation Criteria" from the archived raw page
+
+    Args:
+        archived_trial (dict): An archived trial, see read_archived_trial
+
+    Returns:
+        dict: the extracted fields, or None if there is no raw page or it can't be parsed
+    """
+    raw = archived_trial.get('raw')
+    if not raw:
+        return None
+    if archived_trial.get('source') == 'http':
+        try:
+            return study_to_trial_details(json.loads(raw))[1]
+        except (json.JSONDecodeError, AttributeError):
+            return None
+    return extract_trial_page(raw)
+
+
+def parse_archived_trial(sha, archive_dir=TRIAL_ARCHIVE_DIR, from_raw=True):
+    """Re-runs the scraper's parsing on an archived trial. Runs in the worker processes of reparse_archive.
+
+    Args:
+        sha (str): Hash of the archived object
+        archive_dir (str, optional): Defaults to TRIAL_ARCHIVE_DIR.
+        from_raw (bool, optional): Re-extract the fields from the raw page (browser HTML or API JSON) instead of
+            only re-running the regexes on the stored fields. Falls back to the stored fields. Defaults to True.
+
+    Returns:
+        dict: trial_id, study_title, inclusion_criteria and exclusion_criteria, or None if the trial can't be parsed
+    """
+    archived_trial = read_archived_trial(sha, archive_dir)
+    extracted = (extract_from_raw(archived_trial) if from_raw else None) or archived_trial.get('extracted') or {}
+    if "Study Overview" not in extracted or "Participation Criteria" not in extracted:
+        return None
+    return {
+        "trial_id": archived_trial['trial_id'],
+        "study_title": extract_title(extracted["Study Overview"]),
+        "inclusion_criteria": extract_inclusion_criteria(extracted["Participation Criteria"]),
+        "exclusion_criteria": extract_exclusion_criteria(extracted["Participation Criteria"])
+    }
+
+
+def upsert_changed_entries(collection, model, ids, documents, study_titles, batch_size=500):
+    """Embeds and upserts the entries whose text or title differs from what's in the collection
+
+    Args:
+        collection (chromadb.collection): Collection to update
+        model (embedding model): Embedding model, ideally wrapped with the embedding cache
+        ids (list): Trial IDs
+        documents (list): Text of each trial to embed
+        study_titles (list): Title of each trial
+        batch_size (int, optional): Entries per ChromaDB call. Defaults to 500.
+
+    Returns:
+        tuple: (IDs that were upserted, the subset of them whose text changed rather than only the title)
+    """
+    changed_ids, text_changed_ids = [], []
+    for start in range(0, len(ids), batch_size):
+        batch_ids = ids[start:start + batch_size]
+        batch_documents = documents[start:start + batch_size]
+        batch_titles = study_titles[start:start + batch_size]
+        existing = collection.get(ids=batch_ids, include=['documents', 'metadatas'])
+        existing = {id: (document, (metadata or {}).get('study_title'))
+                    for id, document, metadata in zip(existing['ids'], existing['documents'], existing['metadatas'])}
+        changed = [i for i, id in enumerate(batch_ids) if existing.get(id) != (batch_documents[i], batch_titles[i])]
+        if not changed:
+            continue
+        embeddings = model.encode([batch_documents[i] for i in changed])
+        collection.upsert(
+            embeddings=[embedding.tolist() for embedding in embeddings],
+            documents=[batch_documents[i] for i in changed],
+            metadatas=[{"trial_id": batch_ids[i], "study_title": batch_titles[i]} for i in changed],
+            ids=[batch_ids[i] for i in changed]
+        )
+        changed_ids.extend(batch_ids[i] for i in changed)
+        text_changed_ids.extend(batch_ids[i] for i in changed
+                                if batch_ids[i] in existing and existing[batch_ids[i]][0] != batch_documents[i])
+    return changed_ids, text_changed_ids
+
+
+def reparse_archive(workers=None, embed=True, archive_dir=TRIAL_ARCHIVE_DIR, from_raw=True):
+    """Rebuilds every archived trial's title and criteria in parallel across cores, then re-embeds and upserts
+    only the trials whose parsed text differs from ChromaDB. Texts embedded before (e.g. after a ChromaDB wipe)
+    are served by the embedding cache instead of the model. The updated trials go through reverse matching,
+    stored verdicts of trials whose criteria text changed are dropped and adjudicated again.
+
+    Args:
+        workers (int, optional): Number of worker processes. Defaults to the number of cores.
+        embed (bool, optional): Update the ChromaDB collections. Defaults to True.
+        archive_dir (str, optional): Defaults to TRIAL_ARCHIVE_DIR.
+        from_raw (bool, optional): Re-extract the fields from the raw pages. Defaults to True.
+
+    Returns:
+        list: the parsed trial records
+    """
+    index = load_archive_index(archive_dir)
+    shas = [entry['sha256'] for entry in index.values()]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        records = list(executor.map(parse_archived_trial, shas, [archive_dir] * len(shas), [from_raw] * len(shas),
+                                    chunksize=max(1, len(shas) // ((workers or os.cpu_count() or 1) * 4))))
+    records = [record for record in records if record is not None]
+    print(f"Re-parsed {len(records)} of {len(shas)} archived trials")
+    if not embed or not records:
+        return records
+
+    from create_clinical_trial_embeddings import init
+    from embedding_cache import print_cache_stats, model_key
+    from embedding_snapshot import refresh_snapshot
+    from reverse_matching import match_new_trials_to_patients
+    inclusion_collection, exclusion_collection, embedding_model = init()
+    ids = [record['trial_id'] for record in records]
+    study_titles = [record['study_title'] for record in records]
+    updated_ids, text_changed_ids = set(), set()
+    for collection, field in ((inclusion_collection, 'inclusion_criteria'), (exclusion_collection, 'exclusion_criteria')):
+        changed_ids, collection_text_changed_ids = upsert_changed_entries(
+            collection, embedding_model, ids, [record[field] for record in records], study_titles)
+        print(f"{collection.name}: {len(changed_ids)} trials updated")
+        refresh_snapshot(collection, changed_ids=changed_ids, model_key=model_key(embedding_model))
+        updated_ids.update(changed_ids)
+        text_changed_ids.update(collection_text_changed_ids)
+    print_cache_stats(embedding_model)
+    if updated_ids:
+        # Retrieve the patients for the updated trials, invalidating the verdicts of the ones with new criteria
+        match_new_trials_to_patients(sorted(updated_ids), inclusion_collection, exclusion_collection,
+                                     changed_trial_ids=sorted(text_changed_ids),
+                                     model_key=model_key(embedding_model))
+    return records
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Trial page archive")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    reparse_parser = subparsers.add_parser('reparse', help="Rebuild trial records and embeddings from the archive")
+    reparse_parser.add_argument('--workers', type=int, default=None)
+    reparse_parser.add_argument('--no-embed', action='store_true', help="Only parse, don't update ChromaDB")
+    reparse_parser.add_argument('--from-extracted', action='store_true',
+                                help="Only re-run the regexes on the stored fields, don't re-extract from the raw pages")
+    subparsers.add_parser('stats', help="Number of archived trials and size on disk")
+    args = parser.parse_args()
+
+    if args.command == 'reparse':
+        reparse_archive(workers=args.workers, embed=not args.no_embed, from_raw=not args.from_extracted)
+    else:
+        index = load_archive_index()
+        size = sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(os.path.join(TRIAL_ARCHIVE_DIR, 'objects')) for name in names)
+        print(f"{len(index)} archived trials, {size / 1e6:.1f} MB compressed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import re
+from html.parser import HTMLParser
+
+# Parsing of fetched trial pages into the title and criteria that get embedded, kept free of the scraper's
+# dependencies (crawl4ai, ChromaDB, the embedding model) so the trial_archive.py reparse workers stay light.
+# - extract_trial_page: the browser scraper's CSS extraction, re-run on the archived page HTML
+# - study_to_trial_details: clinicaltrials.gov API (v2) study JSON -> the same fields
+# - extract_title / extract_*_criteria: the regexes applied to those fields
+
+# Elements without a closing tag, they never go on the element stack
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source',
+                 'track', 'wbr'}
+
+
+class TrialPageParser(HTMLParser):
+    """Collects the text of the two elements get_trial_details_by_id extracts from a study page:
+    "div#study-overview" and "#participation-criteria > ctg-participation-criteria:nth-child(2)".
+    Text nodes are stripped and joined without a separator, like crawl4ai's "text" fields.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        # One entry per open element: [tag, id, number of child elements seen so far, field it belongs to]
+        self.stack = []
+        self.texts = {"Study Overview": [], "Participation Criteria": []}
+        self.found = set()
+
+    def _field(self, tag, attributes):
+        if not self.stack:
+            return None
+        parent = self.stack[-1]
+        if parent[3] is not None:
+            return parent[3]
+        if tag == 'div' and attributes.get('id') == 'study-overview':
+            return "Study Overview"
+        if tag == 'ctg-participation-criteria' and parent[1] == 'participation-criteria' and parent[2] == 2:
+            return "Participation Criteria"
+        return None
+
+    def handle_starttag(self, tag, attrs):
+        attributes = dict(attrs)
+        if self.stack:
+            self.stack[-1][2] += 1
+        else:
+            self.stack.append([None, None, 1, None])  # Document root
+        field = self._field(tag, attributes)
+        if field is not None:
+            self.found.add(field)
+        if tag not in VOID_ELEMENTS:
+            self.stack.append([tag, attributes.get('id'), 0, field])
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.stack.pop()
+
+    def handle_endtag(self, tag):
+        # Close up to the matching open tag, tolerating unclosed elements in between
+        for depth in range(len(self.stack) - 1, 0, -1):
+            if self.stack[depth][0] == tag:
+                del self.stack[depth:]
+                return
+
+    def handle_data(self, data):
+        if self.stack and self.stack[-1][3] is not None and data.strip():
+            self.texts[self.stack[-1][3]].append(data.strip())
+
+
+def extract_trial_page(html):
+    """Extracts "Study Overview" and "Participation Criteria" from a rendered study page, the same fields
+    web_scraper_trials.get_trial_details_by_id gets from the browser
+
+    Args:
+        html (str): HTML of the study page
+
+    Returns:
+        dict: {"Study Overview": str, "Participation Criteria": str}, or None if either element is missing
+    """
+    parser = TrialPageParser()
+    parser.feed(html)
+    parser.close()
+    if len(parser.found) < 2:
+        return None
+    return {field: ''.join(texts) for field, texts in parser.texts.items()}
+
+
+def study_to_trial_details(study):
+    """Maps an API study record to the fields extracted from the study page by the browser scraper
+
+    Args:
+        study (dict): A study as returned by the API, with a protocolSection
+
+    Returns:
+        tuple: (NCT ID, {"Study Overview": str, "Participation Criteria": str})
+    """
+    protocol = study.get('protocolSection', {})
+    identification = protocol.get('identificationModule', {})
+    description = protocol.get('descriptionModule', {})
+    conditions = protocol.get('conditionsModule', {}).get('conditions', [])
+    eligibility = protocol.get('eligibilityModule', {})
+
+    nct_id = identification.get('nctId')
+    official_title = ' '.join((identification.get('officialTitle') or identification.get('briefTitle') or '').split())
+    # Laid out like the study page text, extract_title looks for "Official Title ... Conditions" on one line
+    study_overview = (f"{description.get('briefSummary', '')}\n"
+                      f"Official Title {official_title} Conditions\n"
+                      f"{', '.join(conditions)}")
+    return nct_id, {
+        "Study Overview": study_overview,
+        "Participation Criteria": eligibility.get('eligibilityCriteria', '')
+    }
+
+
+def extract_title(data):
+    """Extract the title from a given string using Regular Expression. 
+
+    Args:
+        data (str): Input data
+
+    Returns:
+        str: Extracted title
+    """
+    match = re.search(r'Official Title(.*)Conditions', data)
+    if match:
+        official_title = match.group(1).strip()
+        # print(official_title)
+        return official_title
+    else:
+        # print("Official Title not found")
+        return data
+
+
+def extract_inclusion_criteria(data):
+    """Extract the Inclusion Criteria from a given string using Regular Expression. 
+
+    Args:
+        data (str): Input data
+
+    Returns:
+        str: Extracted criteria
+    """
+    inclusion_match = re.search(r'Inclusion Criteria:(.*)Exclusion Criteria:', data, re.DOTALL)
+    if inclusion_match:
+        inclusion_criteria = inclusion_match.group(1).strip()
+        # print("Inclusion Criteria:\n", inclusion_criteria)
+        return inclusion_criteria
+    else:
+        return data
+
+
+def extract_exclusion_criteria(data):
+    """Extract the Exclusion Criteria from a given string using Regular Expression. 
+
+    Args:
+        data (str): Input data
+
+    Returns:
+        str: Extracted criteria
+    """
+    exclusion_match = re.search(r'Exclusion Criteria:(.*)', data, re.DOTALL)
+    if exclusion_match:
+        exclusion_criteria = exclusion_match.group(1).strip()
+        # print("\nExclusion Criteria:\n", exclusion_criteria)
+        return exclusion_criteria
+    else:
+        return data
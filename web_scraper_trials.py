@@ -1,6 +1,5 @@
 import asyncio
 import json
-import re
 from crawl4ai import AsyncWebCrawler
 from crawl4ai.extraction_strategy import JsonCssExtractionStrategy
 from collections import defaultdict
@@ -8,6 +7,13 @@ from tenacity import retry, stop_after_attempt, wait_exponential
 import os
 from tqdm import tqdm
 from create_clinical_trial_embeddings import init, embed_and_add_single_entry, check_id_exists
+from embedding_cache import print_cache_stats, model_key
+from embedding_snapshot import refresh_snapshot
+from reverse_matching import match_new_trials_to_patients
+from trial_archive import archive_trial_page
+from trial_api_client import CLINICAL_TRIALS_API_URL, create_session, fetch_recruiting_trials
+from trial_parsing import extract_title, extract_inclusion_criteria, extract_exclusion_criteria, study_to_trial_details
+from instrumentation import span, count, export_run
 
 async def extract_nct_ids(crawler, trials_per_page=25, page_number=1):
     """This function handles scraping the Trial ID 'NCT_ID' from the clinicaltrials.gov website
@@ -96,8 +102,9 @@ async def get_trial_details_by_id(crawler, trial_id):
     };
     """
 
+    trial_url = f"https://clinicaltrials.gov/study/{trial_id}"
     trial_details_per_id = await crawler.arun(
-                            url=f"https://clinicaltrials.gov/study/{trial_id}",
+                            url=trial_url,
                             extraction_strategy=extraction_strategy,
                             verbose=False,
                             js_code=js_code
@@ -106,112 +113,133 @@ async def get_trial_details_by_id(crawler, trial_id):
         print("Failed to crawl the page")
 
     try:
-        return json.loads(trial_details_per_id.extracted_content)[0]
+        trial_page_details = json.loads(trial_details_per_id.extracted_content)[0]
     except Exception as e:
-        pass
+        return None
+    # Keep the page in the archive, so parser fixes can be re-run offline (trial_archive.py reparse)
+    archive_trial_page(trial_id, trial_page_details, raw=trial_details_per_id.html, source='browser', url=trial_url)
+    return trial_page_details
 
-def extract_title(data):
-    """Extract the title from a given string using Regular Expression. 
+def add_trial_to_collections(id, trial_page_details, inclusion_collection, exclusion_collection, embedding_model):
+    """Parses the title and criteria of a fetched trial, embeds them and adds them to the ChromaDB collections
 
     Args:
-        data (str): Input data
-
-    Returns:
-        str: Extracted title
-    """
-    match = re.search(r'Official Title(.*)Conditions', data)
-    if match:
-        official_title = match.group(1).strip()
-        # print(official_title)
-        return official_title
-    else:
-        # print("Official Title not found")
-        return data
-
-def extract_inclusion_criteria(data):
-    """Extract the Inclusion Criteria from a given string using Regular Expression. 
-
-    Args:
-        data (str): Input data
-
-    Returns:
-        str: Extracted criteria
+        id (str): NCT ID of the trial
+        trial_page_details (dict): "Study Overview" and "Participation Criteria" of the trial
+        inclusion_collection (chromadb.collection): inclusion_criteria collection
+        exclusion_collection (chromadb.collection): exclusion_criteria collection
+        embedding_model (embedding model): The embedding model object
     """
-    inclusion_match = re.search(r'Inclusion Criteria:(.*)Exclusion Criteria:', data, re.DOTALL)
-    if inclusion_match:
-        inclusion_criteria = inclusion_match.group(1).strip()
-        # print("Inclusion Criteria:\n", inclusion_criteria)
-        return inclusion_criteria
-    else:
-        return data
+    study_title = extract_title(trial_page_details["Study Overview"])
+    # Excluding the exclusion criteria, because I don't want to match keywords (vectors) 
+    # present in the patient's summary with exclusion criteria. My idea is to 
+    # only get list of trials that match inclusion criteria with the patient and then ask an LLM
+    # to 
+    inclusion_criteria = extract_inclusion_criteria(trial_page_details["Participation Criteria"])
+    exclusion_criteria = extract_exclusion_criteria(trial_page_details["Participation Criteria"])
     
-def extract_exclusion_criteria(data):
-    """Extract the Exclusion Criteria from a given string using Regular Expression. 
-
-    Args:
-        data (str): Input data
-
-    Returns:
-        str: Extracted criteria
-    """
-    exclusion_match = re.search(r'Exclusion Criteria:(.*)', data, re.DOTALL)
-    if exclusion_match:
-        exclusion_criteria = exclusion_match.group(1).strip()
-        # print("\nExclusion Criteria:\n", exclusion_criteria)
-        return exclusion_criteria
-    else:
-        return data
-
-
-async def main():
+    # data_to_embed = f'Inclusion Criteria: {inclusion_criteria}, Exclusion Criteria: {exclusion_criteria}'
+    embed_and_add_single_entry(inclusion_collection, embedding_model, inclusion_criteria, id, study_title)
+    embed_and_add_single_entry(exclusion_collection, embedding_model, exclusion_criteria, id, study_title)
+    count('scraper.trials_added')
+
+async def scrape_with_browser(max_pages, trials_per_page, inclusion_collection, exclusion_collection,
+                              embedding_model, pbar, new_trial_ids, failed_list):
+    """Scrapes the trials by rendering the search and study pages in crawl4ai's headless browser"""
+    async with AsyncWebCrawler(verbose=False) as crawler:
+        page_number = 1 # Start crawling from page 1
+        while page_number<max_pages:
+            # Get the currently recruiting Trial IDs
+            trial_ids_set = await extract_nct_ids(crawler, 
+                                                trials_per_page,
+                                                page_number=page_number)
+
+            for id in trial_ids_set:
+                # Check if ID exists already, if yes, skip:
+                if check_id_exists(inclusion_collection, id): 
+                    # print(id," exists", end='\r')
+                    pbar.update(1)
+                    continue
+                with span('scraper.fetch_trial'):
+                    trial_page_details = await get_trial_details_by_id(crawler, id)
+                if trial_page_details is None: 
+                    pbar.update(1)
+                    # Keep track of failed trial scrapes
+                    failed_list.append(id)
+                    continue
+                add_trial_to_collections(id, trial_page_details, inclusion_collection, exclusion_collection, embedding_model)
+                new_trial_ids.append(id)
+                pbar.update(1)
+            
+            page_number+=1
+
+async def scrape_with_http(max_pages, trials_per_page, inclusion_collection, exclusion_collection,
+                           embedding_model, pbar, new_trial_ids, failed_list, api_url=CLINICAL_TRIALS_API_URL):
+    """Scrapes the trials as JSON from the clinicaltrials.gov API over pooled HTTP, no browser involved.
+    The listing already contains the criteria, so there is no request per trial.
+    Like the browser mode, pages 1 to max_pages-1 are fetched."""
+    async with create_session() as session:
+        async for studies in fetch_recruiting_trials(session, trials_per_page, max_pages - 1, api_url):
+            for study in studies:
+                id, trial_page_details = study_to_trial_details(study)
+                if id is None or check_id_exists(inclusion_collection, id):
+                    pbar.update(1)
+                    continue
+                if not trial_page_details["Participation Criteria"]:
+                    pbar.update(1)
+                    failed_list.append(id)
+                    continue
+                # Keep the record in the archive, so parser fixes can be re-run offline (trial_archive.py reparse)
+                archive_trial_page(id, trial_page_details, raw=json.dumps(study), source='http',
+                                   url=f"{api_url}/studies/{id}")
+                add_trial_to_collections(id, trial_page_details, inclusion_collection, exclusion_collection, embedding_model)
+                new_trial_ids.append(id)
+                pbar.update(1)
+
+async def main(fetch_mode='browser', max_pages=16, trials_per_page=50, api_url=CLINICAL_TRIALS_API_URL):
     """
     The main method helps scrape the given number of pages from the clinicaltrials.gov website
     This then fetches latest trials and extracts key info and puts it in a vector store,
     in this case a chromadb local persistent storage file.
+
+    Args:
+        fetch_mode (str, optional): 'browser' (crawl4ai headless browser) or 'http' (JSON API). Defaults to 'browser'.
+        max_pages (int, optional): Pages 1 to max_pages-1 are scraped. Defaults to 16.
+        trials_per_page (int, optional): Defaults to 50.
+        api_url (str, optional): API base URL for the 'http' mode. Defaults to CLINICAL_TRIALS_API_URL.
     """
-    max_pages = 16 # Change it how many ever needed
-    trials_per_page = 50 # Change it how many ever needed
     total_trials_to_scrape = ((max_pages-1)*trials_per_page)
     inclusion_collection, exclusion_collection, embedding_model = init()
     failed_list = []
-    async with AsyncWebCrawler(verbose=False) as crawler:
-        page_number = 1 # Start crawling from page 1
-        with tqdm(total=total_trials_to_scrape, desc='Clinical Trials Scraped: ') as pbar:
-            while page_number<max_pages:
-                # Get the currently recruiting Trial IDs
-                trial_ids_set = await extract_nct_ids(crawler, 
-                                                    trials_per_page,
-                                                    page_number=page_number)
-
-                for id in trial_ids_set:
-                    # Check if ID exists already, if yes, skip:
-                    if check_id_exists(inclusion_collection, id): 
-                        # print(id," exists", end='\r')
-                        pbar.update(1)
-                        continue
-                    trial_page_details = await get_trial_details_by_id(crawler, id)
-                    if trial_page_details is None: 
-                        pbar.update(1)
-                        # Keep track of failed trial scrapes
-                        failed_list.append(id)
-                        continue
-                    study_title = extract_title(trial_page_details["Study Overview"])
-                    # Excluding the exclusion criteria, because I don't want to match keywords (vectors) 
-                    # present in the patient's summary with exclusion criteria. My idea is to 
-                    # only get list of trials that match inclusion criteria with the patient and then ask an LLM
-                    # to 
-                    inclusion_criteria = extract_inclusion_criteria(trial_page_details["Participation Criteria"])
-                    exclusion_criteria = extract_exclusion_criteria(trial_page_details["Participation Criteria"])
-                    
-                    # data_to_embed = f'Inclusion Criteria: {inclusion_criteria}, Exclusion Criteria: {exclusion_criteria}'
-                    embed_and_add_single_entry(inclusion_collection, embedding_model, inclusion_criteria, id, study_title)
-                    embed_and_add_single_entry(exclusion_collection, embedding_model, exclusion_criteria, id, study_title)
-                    pbar.update(1)
-                
-                page_number+=1
+    new_trial_ids = []
+    with tqdm(total=total_trials_to_scrape, desc='Clinical Trials Scraped: ') as pbar:
+        if fetch_mode == 'http':
+            await scrape_with_http(max_pages, trials_per_page, inclusion_collection, exclusion_collection,
+                                   embedding_model, pbar, new_trial_ids, failed_list, api_url)
+        else:
+            await scrape_with_browser(max_pages, trials_per_page, inclusion_collection, exclusion_collection,
+                                      embedding_model, pbar, new_trial_ids, failed_list)
 
     print(f"Finished scraping {total_trials_to_scrape} Clinical Trials. Added them to a local ChromaDB Vector Store")
     print(f"Here is a list trials that failed during scraping: ", failed_list)
-    print(f"Total number of records in ChromaDB: ", inclusion_collection.count())         
-
-asyncio.run(main())
\ No newline at end of file
+    print(f"Total number of records in ChromaDB: ", inclusion_collection.count())
+    print_cache_stats(embedding_model)
+    # Export the new trial embeddings to the memory-mapped snapshot used by the matching step
+    refresh_snapshot(inclusion_collection, model_key=model_key(embedding_model))
+    refresh_snapshot(exclusion_collection, model_key=model_key(embedding_model))
+    # Find the already embedded patients that match the new trials, instead of re-matching the whole cohort
+    match_new_trials_to_patients(new_trial_ids, inclusion_collection, exclusion_collection,
+                                 model_key=model_key(embedding_model))
+    # Per-run timings and counters, only written when PIPELINE_METRICS=1
+    export_run('web_scraper_trials')
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Scrape recruiting clinical trials into ChromaDB")
+    parser.add_argument('--fetch-mode', choices=('browser', 'http'), default='browser',
+                        help="'browser' renders the pages with crawl4ai, 'http' pulls JSON from the API")
+    parser.add_argument('--max-pages', type=int, default=16) # Change it how many ever needed
+    parser.add_argument('--trials-per-page', type=int, default=50) # Change it how many ever needed
+    parser.add_argument('--api-url', default=CLINICAL_TRIALS_API_URL, help="API base URL for the 'http' mode")
+    args = parser.parse_args()
+    asyncio.run(main(args.fetch_mode, args.max_pages, args.trials_per_page, args.api_url))
\ No newline at end of file